@@ -0,0 +1,227 @@
+'''
+Benchmark of the zoning algorithm on synthetic data.
+
+Builds a synthetic population raster and a layout of synthetic municipalities (and land use
+parcels) for each requested size, runs the zoning stages one at a time, and appends the wall
+time of each stage to a csv file, so that runs before and after a change can be compared:
+
+    python -m pyGr.benchmark output/benchmark --sizes 256 1024 --regions 16 100 --label my-change
+
+No ALKIS or Zensus data is needed, everything is generated from the seed.
+'''
+import argparse
+import csv
+import os
+import time
+import ConfigParser
+
+import numpy as np
+import fiona
+import rasterio
+from fiona.crs import from_epsg
+from affine import Affine
+from shapely.geometry import Polygon, box, mapping
+
+from pyGr.common.region_ops import Regions
+from pyGr.zoning_algorithm import octtree, helper_functions, tabulation
+from pyGr.zoning_algorithm.integral_image import IntegralImage
+
+CRS = from_epsg(31468)
+RESOLUTION = 100
+CLASS_FIELD = 'OBJART'
+FIELD_VALUES = [('ax_wohnbauflaeche', 'Housing'),
+                ('ax_flaechegemischternutzung', 'Mixed Use'),
+                ('ax_industrieundgewerbeflaeche', 'Industrial')]
+
+RESULT_FIELDS = ['label', 'date', 'size', 'regions', 'threshold', 'stage', 'seconds', 'zones']
+
+
+def synthetic_affine():
+    return Affine(RESOLUTION, 0, 4400000, 0, -RESOLUTION, 5400000)
+
+def synthetic_raster(size, seed=0):
+    '''
+    A (size, size) integer population raster: towns of random size and spread, with about a
+    third of the cells left empty. The first rows are nodata (-1) as outside the study area.
+    '''
+    rs = np.random.RandomState(seed)
+    raster = np.zeros((size, size))
+
+    num_towns = max(1, size * size // 4096)
+    for (row, col, peak, spread) in zip(rs.randint(0, size, num_towns), rs.randint(0, size, num_towns),
+                                        rs.pareto(1.5, num_towns) * 50 + 5, rs.uniform(2, 12, num_towns)):
+        #only the window within four standard deviations of the centre is worth adding
+        reach = int(4 * spread)
+        (r0, r1) = (max(0, row - reach), min(size, row + reach + 1))
+        (c0, c1) = (max(0, col - reach), min(size, col + reach + 1))
+        (rr, cc) = np.ogrid[r0:r1, c0:c1]
+        raster[r0:r1, c0:c1] += peak * np.exp(-((rr - row) ** 2 + (cc - col) ** 2) / (2.0 * spread ** 2))
+
+    raster = np.round(raster * rs.uniform(0.5, 1.5, raster.shape)).astype(np.int32)
+    raster[rs.rand(size, size) < 0.3] = 0
+    raster[:max(1, size // 64)] = -1
+    return raster
+
+def synthetic_regions(size, num_regions, affine, seed=0):
+    '''
+    Municipalities as a jittered lattice of quadrilaterals covering the raster. Neighbours share
+    their corner points exactly, and most boundaries are slanted, so every region clips grid squares.
+    Features carry the AGS_Int identifier like the real region shapefile.
+    '''
+    rs = np.random.RandomState(seed)
+    n = max(1, int(round(np.sqrt(num_regions))))
+    step = size / float(n)
+
+    #jitter the inner lattice points only, so the outer boundary stays the raster edge
+    (rows, cols) = np.mgrid[0:n + 1, 0:n + 1].astype(np.float64) * step
+    jitter = rs.uniform(-0.35, 0.35, (2, n - 1, n - 1)) * step
+    rows[1:-1, 1:-1] += jitter[0]
+    cols[1:-1, 1:-1] += jitter[1]
+    (xs, ys) = affine * (cols, rows)
+
+    features = []
+    for i in xrange(n):
+        for j in xrange(n):
+            corners = [(xs[i, j], ys[i, j]), (xs[i, j + 1], ys[i, j + 1]),
+                       (xs[i + 1, j + 1], ys[i + 1, j + 1]), (xs[i + 1, j], ys[i + 1, j])]
+            features.append({'geometry': mapping(Polygon(corners)),
+                             'properties': {'AGS_Int': 9000000 + i * n + j}})
+    return features
+
+def write_land_use(folder, size, affine, num_districts=2, parcels_per_district=2000, seed=0):
+    '''
+    Land use parcels in the ALKIS layout: a sub folder per district, each with a 'Siedlung' shapefile.
+    Districts overlap by a strip, and parcels in the overlap are written to both with the same OID.
+    '''
+    rs = np.random.RandomState(seed)
+    (minx, maxy) = affine * (0, 0)
+    width = size * RESOLUTION
+    schema = {'geometry': 'Polygon', 'properties': [('OID', 'str'), (CLASS_FIELD, 'str')]}
+    classes = ['AX_Wohnbauflaeche', 'AX_FlaecheGemischterNutzung', 'AX_IndustrieUndGewerbeflaeche', 'AX_Wald']
+
+    num_parcels = num_districts * parcels_per_district
+    x = minx + rs.uniform(0, width, num_parcels)
+    y = maxy - rs.uniform(0, width, num_parcels)
+    (w, h) = rs.uniform(20, 4 * RESOLUTION, (2, num_parcels))
+    parcel_classes = rs.randint(0, len(classes), num_parcels)
+
+    band = width / float(num_districts)
+    for d in xrange(num_districts):
+        district_folder = os.path.join(folder, "district_%d" % d)
+        if not os.path.exists(district_folder):
+            os.makedirs(district_folder)
+        in_district = (x >= minx + d * band - RESOLUTION) & (x < minx + (d + 1) * band + RESOLUTION)
+        with fiona.open(os.path.join(district_folder, "Siedlung.shp"), 'w', driver="ESRI Shapefile",
+                        crs=CRS, schema=schema) as c:
+            for p in np.flatnonzero(in_district):
+                c.write({'geometry': mapping(box(x[p], y[p], x[p] + w[p], y[p] + h[p])),
+                         'properties': {'OID': "DEBY%010d" % p, CLASS_FIELD: classes[parcel_classes[p]]}})
+
+def write_raster(filename, array, affine):
+    with rasterio.open(filename, 'w', driver='GTiff', width=array.shape[1], height=array.shape[0], count=1,
+                       dtype=array.dtype, crs=CRS, transform=affine) as out:
+        out.write(array, 1)
+
+def build_inputs(folder, size, num_regions, seed=0, parcels_per_district=2000):
+    '''
+    Write the synthetic rasters and land use for one case, and return a Config for it and the regions.
+    Population is 60 percent of the combined raster and employment the rest, as float rasters.
+    '''
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    affine = synthetic_affine()
+    combined = synthetic_raster(size, seed)
+    clipped = np.clip(combined, 0, None).astype(np.float64)
+
+    Config = ConfigParser.ConfigParser(allow_no_value=True)
+    for section in ["Input", "Parameters", "Output"]:
+        Config.add_section(section)
+    Config.set("Input", "combined_raster", os.path.join(folder, "combined.tif"))
+    Config.set("Input", "pop_raster", os.path.join(folder, "population.tif"))
+    Config.set("Input", "emp_raster", os.path.join(folder, "employment.tif"))
+    Config.set("Parameters", "minimum_zone_population", "500")
+    Config.set("Parameters", "minimum_zone_area", "5000")
+    Config.set("Output", "filename", os.path.join(folder, "zones"))
+
+    write_raster(Config.get("Input", "combined_raster"), combined, affine)
+    write_raster(Config.get("Input", "pop_raster"), clipped * 0.6, affine)
+    write_raster(Config.get("Input", "emp_raster"), clipped * 0.4, affine)
+    write_land_use(os.path.join(folder, "land_use"), size, affine, parcels_per_district=parcels_per_district, seed=seed)
+
+    regions = Regions(synthetic_regions(size, num_regions, affine, seed))
+    return (Config, combined, affine, regions)
+
+def run_case(Config, raster, affine, regions, pop_threshold, land_use_folder, processes=1):
+    '''
+    Run the stages of build_out_nodes, then the final values, land use tabulation and both writers,
+    timing each one. Returns a list of (stage, seconds, zones)
+    '''
+    results = []
+    state = {}
+
+    def timed(stage, f):
+        start = time.time()
+        f()
+        seconds = time.time() - start
+        zones = state['tree'].count_populated() if 'tree' in state else 0
+        print "\t%-26s %8.3fs %8d zones" % (stage, seconds, zones)
+        results.append((stage, seconds, zones))
+
+    def build():
+        raster_sums = IntegralImage(raster)
+        state['tree'] = octtree.build(octtree.Octtree(raster.shape, affine), raster_sums, pop_threshold)
+
+    def split():
+        state['to_merge'] = octtree.split(Config, state['tree'], regions, raster, affine)
+
+    timed('build', build)
+    timed('split', split)
+    timed('merge', lambda: octtree.merge(Config, state['tree'], state['to_merge'], pop_threshold))
+    timed('prune', lambda: state['tree'].prune(regions.prepared_boundary()))
+    timed('calculate_final_values', lambda: helper_functions.calculate_final_values(Config, state['tree']))
+    timed('run_tabulate_intersection',
+          lambda: tabulation.run_tabulate_intersection(state['tree'], land_use_folder, CLASS_FIELD, FIELD_VALUES,
+                                                       processes))
+    timed('save', lambda: helper_functions.save(Config.get("Output", "filename"), CRS, state['tree'],
+                                                include_land_use=True, field_values=FIELD_VALUES))
+    timed('save_geopackage', lambda: helper_functions.save_geopackage(Config.get("Output", "filename") + ".gpkg", CRS,
+                                                                      state['tree'], include_land_use=True,
+                                                                      field_values=FIELD_VALUES))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the zoning stages on synthetic data")
+    parser.add_argument("out", help="Folder for the synthetic inputs and zones", default='output/benchmark')
+    parser.add_argument("-s", "--sizes", help="Raster sizes in cells (square)", type=int, nargs='+', default=[256, 1024])
+    parser.add_argument("-r", "--regions", help="Numbers of municipalities", type=int, nargs='+', default=[16, 100])
+    parser.add_argument("-t", "--threshold", help="Population threshold", type=int, default=2000)
+    parser.add_argument("-p", "--parcels", help="Land use parcels per district", type=int, default=2000)
+    parser.add_argument("-n", "--processes", help="Worker processes for the land use tabulation", type=int, default=1)
+    parser.add_argument("--seed", help="Seed for the synthetic data", type=int, default=0)
+    parser.add_argument("-l", "--label", help="Label stored with each result, ie: a commit id", default='')
+    parser.add_argument("-o", "--results", help="csv file the timings are appended to (default: out/benchmark.csv)")
+    args = parser.parse_args()
+
+    results_file = args.results or os.path.join(args.out, "benchmark.csv")
+    date = time.strftime("%Y-%m-%dT%H:%M:%S")
+
+    rows = []
+    for size in args.sizes:
+        for num_regions in args.regions:
+            print "case: %d x %d cells, %d regions" % (size, size, num_regions)
+            folder = os.path.join(args.out, "%d_%d" % (size, num_regions))
+            (Config, raster, affine, regions) = build_inputs(folder, size, num_regions, args.seed, args.parcels)
+            for (stage, seconds, zones) in run_case(Config, raster, affine, regions, args.threshold,
+                                                    os.path.join(folder, "land_use"), args.processes):
+                rows.append({'label': args.label, 'date': date, 'size': size, 'regions': len(regions),
+                             'threshold': args.threshold, 'stage': stage, 'seconds': round(seconds, 4),
+                             'zones': zones})
+
+    write_header = not os.path.exists(results_file)
+    with open(results_file, 'ab') as results_csv:
+        writer = csv.DictWriter(results_csv, fieldnames=RESULT_FIELDS)
+        if write_header:
+            writer.writeheader()
+        writer.writerows(rows)
+    print "results appended to", results_file
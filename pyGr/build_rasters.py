@@ -3,6 +3,7 @@ import os
 import shutil
 from os import path
 from pyGr.common import config
+from pyGr.common.stages import Stage, StageRunner
 
 from fiona.crs import from_epsg
 
@@ -17,13 +18,17 @@ parser.add_argument("out", help="Output_directory", default='output')
 
 parser.add_argument("-t","--temp", help="Temporary directory", default='temp')
 parser.add_argument("-crs","--crs", help="EPSG coordinate reference system", type=int)
-parser.add_argument("-s", "--start", help="algorithm step to start from.\nAll file required from this point must be in the temp or output folder")
+parser.add_argument("-s", "--start", help="algorithm step to start from, ie: employment. Earlier steps are skipped and all later ones run.\nAll file required from this point must be in the temp or output folder")
+parser.add_argument("-f", "--force", help="run every step, even those whose inputs have not changed", action="store_true")
+parser.add_argument("-p", "--processes", help="number of land use districts to encode and rasterize at once", type=int, default=1)
+parser.add_argument("--clean", help="clear the temp and output folders first", action="store_true")
 parser.add_argument("-c", "--check", help="output statistical error information on completion", action="store_true")
+parser.add_argument("--stream", help="build the population, employment and merged rasters strip by strip, in bounded memory", action="store_true")
 
 args = parser.parse_args()
 
 from pyGr.pre_processing import aggregation, extend_shapefile, \
-    encode_landuse, rasters, statistics, gdal_operations
+    encode_landuse, rasters, statistics, gdal_operations, streaming
 
 
 region_shapefile = args.region
@@ -66,74 +71,71 @@ emp_basic_raster_file = path.join(output_folder, "employment_simple_{resolution}
 merged_output_file = path.join(output_folder, "pop_emp_sum_{resolution}m.tif".format(resolution = resolution))
 
 #step flags
-CLEAR_DIRS = True
 ENCODE_LAND_USE_VALUES = True #we already have encoded values in the shapefile
-CREATE_LAND_USE_RASTERS = True
-MERGE_LAND_USE_RASTERS = True
-AGGREGATE_LAND_USE_RASTERS = True
-CLIP_LAND_USE_RASTERS = True
-BUILD_REGION_ID_RASTER = True
-
 ADD_REGION_STATS = False
-
-BUILD_POPULATION_RASTER = True
-BUILD_EMPLOYMENT_RASTER = True
-
-MERGE_POP_EMP_RASTERS = True
 RUN_CHECKING = args.check
+STREAM_REGION_RASTERS = args.stream
 
-if CLEAR_DIRS:
-    #clear temp directory
+if args.clean:
+    #clear temp and output directories, so that every step runs
     shutil.rmtree(temp_directory, ignore_errors=True)
-    os.mkdir(temp_directory)
-
     shutil.rmtree(output_folder, ignore_errors=True)
-    os.mkdir(output_folder)
+for folder in [temp_directory, output_folder]:
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
 
-if ENCODE_LAND_USE_VALUES:
+#districts whose outputs are newer than their inputs are not encoded or rasterized again
+def encode_land_use_values():
     #encode land use values to new shapefile
-    encoded_lu_folder = path.join(temp_directory, "encoded_landuse")
-    os.mkdir(encoded_lu_folder)
-    encode_landuse.encode_shapefiles(land_use_config, land_use_shapefiles, encoded_lu_folder)
-    #
-else:
-    encoded_lu_folder = land_use_shapefiles
+    if not os.path.isdir(encoded_lu_folder):
+        os.mkdir(encoded_lu_folder)
+    encode_landuse.encode_shapefiles(land_use_config, land_use_shapefiles, encoded_lu_folder,
+                                     processes=args.processes, skip_up_to_date=True)
 
-if CREATE_LAND_USE_RASTERS:
+def create_land_use_rasters():
     #convert land use shapefile to raster
     print("\nconvert land use shapefile to raster...")
-    try:
+    if not os.path.isdir(rasterized_lu_folder):
         os.mkdir(rasterized_lu_folder)
-    except:
-        print rasterized_lu_folder, "already exists, continuing"
-    gdal_operations.create_land_use_rasters(encoded_lu_folder, rasterized_lu_folder, crs)
+    gdal_operations.create_land_use_rasters(encoded_lu_folder, rasterized_lu_folder, crs,
+                                            processes=args.processes, skip_up_to_date=True)
 
-if MERGE_LAND_USE_RASTERS:
+def merge_land_use_rasters():
     #merge land use rasters
     print("\nmerge land use rasters...")
     gdal_operations.merge_rasters(rasterized_lu_folder, merged_lu_raster)
 
-if AGGREGATE_LAND_USE_RASTERS:
+def aggregate_land_use_rasters():
     #aggregate land use raster
     print("\naggregate land use raster")
     aggregation.run_land_use_aggregation(merged_lu_raster, num_land_use_bands, land_use_aggregated, resolution)
 
-if CLIP_LAND_USE_RASTERS:
+def clip_land_use_rasters():
     #clip land use raster to region shapefile
     print "\nclip land use raster to region shapefile..."
     gdal_operations.clip_land_use_raster(land_use_aggregated, region_shapefile, land_use_clipped)
 
-if BUILD_REGION_ID_RASTER:
+def build_region_id_raster():
     #build region_id_raster
     print("\nbuild region_id_raster")
     gdal_operations.create_ags_code_raster(region_shapefile, land_use_clipped, region_id_raster, resolution)
 
-if ADD_REGION_STATS:
+def add_region_stats():
     #calc region land_use stats
     print("\ncalc region land_use stats")
     extend_shapefile.add_region_stats(region_shapefile, region_stats_file, [pop_field, emp_field], regions_with_stats)
 
-if BUILD_POPULATION_RASTER:
+def stream_region_rasters():
+    #population, employment and their sum in two passes over aligned strips, replacing the three steps below
+    print("\nbuild population, employment and merged rasters strip by strip -> to output folder")
+    region_statistics = [streaming.RegionStatistic(regions_with_stats, pop_field, pop_density_raster, [1],
+                                                   pop_area_coverage_raster, pop_raster_file),
+                         streaming.RegionStatistic(regions_with_stats, emp_field, land_use_clipped, scale_factors['employment'],
+                                                   emp_area_coverage_raster, emp_raster_file)]
+    streaming.build_region_rasters(region_id_raster, region_statistics, merged_output_file)
+    rasters.build_simple_employment_raster(regions_with_stats, "employment", region_id_raster, emp_basic_raster_file, emp_field)
+
+def build_population_raster():
     #calc region land_use stats
     print("\nbuild population raster -> to output folder")
     #TODO: analyse pop_density raster, and trim and fit to region and resolution if needed
@@ -146,25 +148,59 @@ if BUILD_POPULATION_RASTER:
     statistics.distribute_region_statistics(regions_with_stats, pop_field,
                                             pop_area_coverage_raster, region_id_raster, pop_raster_file)
 
-
 #build pop and employment rasters -> to output folder
-
-if BUILD_EMPLOYMENT_RASTER:
+def build_employment_raster():
     print("\nbuild employment raster -> to output folder, using scale factors:", scale_factors['employment'])
     rasters.build_emp_raster(regions_with_stats,
                                 land_use_clipped,
                                 region_id_raster,
                                 emp_area_coverage_raster, scale_factors['employment'])
 
-    rasters.build_simple_employment_raster(regions_with_stats, "employment", region_id_raster, emp_basic_raster_file)
+    rasters.build_simple_employment_raster(regions_with_stats, "employment", region_id_raster, emp_basic_raster_file, emp_field)
 
     statistics.distribute_region_statistics(regions_with_stats, emp_field,
                                             emp_area_coverage_raster, region_id_raster, emp_raster_file)
 
 #merge pop and employment rasters -> to output folder
-if MERGE_POP_EMP_RASTERS:
+def merge_pop_emp_rasters():
     rasters.add_rasters(pop_raster_file, emp_raster_file, merged_output_file)
 
+if ENCODE_LAND_USE_VALUES:
+    encoded_lu_folder = path.join(temp_directory, "encoded_landuse")
+else:
+    encoded_lu_folder = land_use_shapefiles
+
+#each step reruns only if the contents of its inputs or its parameters have changed since it last ran
+employment_params = {'emp_field': emp_field, 'scale_factors': scale_factors['employment']}
+stages = [
+    Stage("encode_land_use", encode_land_use_values, [land_use_shapefiles], [encoded_lu_folder],
+          {'class_field': land_use_config.class_field, 'encodings': land_use_config.encodings},
+          enabled=ENCODE_LAND_USE_VALUES),
+    Stage("land_use_rasters", create_land_use_rasters, [encoded_lu_folder], [rasterized_lu_folder], {'crs': crs}),
+    Stage("merge_land_use", merge_land_use_rasters, [rasterized_lu_folder], [merged_lu_raster]),
+    Stage("aggregate_land_use", aggregate_land_use_rasters, [merged_lu_raster], [land_use_aggregated],
+          {'bands': num_land_use_bands, 'resolution': resolution}),
+    Stage("clip_land_use", clip_land_use_rasters, [land_use_aggregated, region_shapefile], [land_use_clipped]),
+    Stage("region_id", build_region_id_raster, [region_shapefile, land_use_clipped], [region_id_raster],
+          {'resolution': resolution}),
+    Stage("region_stats", add_region_stats, [region_shapefile, region_stats_file], [regions_with_stats],
+          {'fields': [pop_field, emp_field]}, enabled=ADD_REGION_STATS),
+    Stage("region_rasters", stream_region_rasters,
+          [regions_with_stats, pop_density_raster, land_use_clipped, region_id_raster],
+          [pop_raster_file, emp_raster_file, merged_output_file, pop_area_coverage_raster, emp_area_coverage_raster,
+           emp_basic_raster_file],
+          dict(employment_params, pop_field=pop_field), enabled=STREAM_REGION_RASTERS),
+    Stage("population", build_population_raster, [regions_with_stats, pop_density_raster, region_id_raster],
+          [pop_raster_file, pop_area_coverage_raster], {'pop_field': pop_field}, enabled=not STREAM_REGION_RASTERS),
+    Stage("employment", build_employment_raster, [regions_with_stats, land_use_clipped, region_id_raster],
+          [emp_raster_file, emp_area_coverage_raster, emp_basic_raster_file], employment_params,
+          enabled=not STREAM_REGION_RASTERS),
+    Stage("merge_pop_emp", merge_pop_emp_rasters, [pop_raster_file, emp_raster_file], [merged_output_file],
+          enabled=not STREAM_REGION_RASTERS),
+]
+
+StageRunner(path.join(temp_directory, "file_hashes.json"), start=args.start, force=args.force).run(stages)
+
 
 if RUN_CHECKING:
     rasters.check_raster_output(regions_with_stats, pop_raster_file, [pop_field])
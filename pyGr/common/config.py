@@ -12,6 +12,7 @@ def load_config(filename):
 
 class LandUseConfig:
     def __init__(self, filename):
+        self.filename = filename
         self.config = load_config(filename)
         self.class_field = self.config.get("Class Field", "Field")
         self.resolution = self.config.getint("Input", "desired_raster_resolution")
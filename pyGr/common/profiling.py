@@ -0,0 +1,107 @@
+'''
+Timing of the zoning stages.
+
+Functions decorated with timed (or blocks run in a stage context) add their wall time, number of calls,
+the number of zones they leave and the peak memory reached while they ran to a per stage record.
+generate_zones writes the records as JSON next to the output. Stages named with configure(profile_stages)
+are also run under cProfile, one stats file per stage, for a closer look at where their time goes.
+'''
+import cProfile
+import functools
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError: #not on windows
+    resource = None
+
+_records = OrderedDict() #stage name -> record
+_profilers = {} #stage name -> cProfile.Profile, for the profiled stages
+_profile_stages = set()
+
+def configure(profile_stages=()):
+    #stages to run under cProfile, 'all' for every stage
+    _profile_stages.clear()
+    _profile_stages.update(profile_stages)
+
+def reset():
+    _records.clear()
+    _profilers.clear()
+
+@contextmanager
+def stage(name):
+    '''
+    Time the block as a run of stage name. The record is yielded, so the block can set record['nodes']
+    '''
+    if name not in _records:
+        _records[name] = OrderedDict([('stage', name), ('calls', 0), ('seconds', 0.0), ('nodes', None),
+                                      ('peak_memory_mb', 0.0)])
+    record = _records[name]
+    profiler = None
+    if name in _profile_stages or 'all' in _profile_stages:
+        profiler = _profilers.setdefault(name, cProfile.Profile())
+
+    _reset_peak_memory()
+    start = time.time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        yield record
+    finally:
+        if profiler is not None:
+            profiler.disable()
+        record['seconds'] += time.time() - start
+        record['calls'] += 1
+        record['peak_memory_mb'] = max(record['peak_memory_mb'], _peak_memory_mb())
+
+def timed(name, nodes=None):
+    '''
+    Decorator running a function as stage name. nodes, if given, is called with the function's
+    arguments once it returns, and gives the number of zones to record (ie: the tree's leaf count)
+    '''
+    def decorator(f):
+        @functools.wraps(f)
+        def wrapper(*args, **kwargs):
+            with stage(name) as record:
+                result = f(*args, **kwargs)
+                if nodes is not None:
+                    record['nodes'] = int(nodes(*args, **kwargs))
+            return result
+        return wrapper
+    return decorator
+
+def results():
+    return [OrderedDict(record) for record in _records.itervalues()]
+
+def write(filename, **info):
+    #write the stage records, with any extra information about the run, and dump the cProfile stats
+    #of the profiled stages to filename.<stage>.prof
+    with open(filename, 'w') as f:
+        json.dump(OrderedDict(sorted(info.items()) + [('stages', results())]), f, indent=2)
+    for (name, profiler) in _profilers.iteritems():
+        profiler.dump_stats("%s.%s.prof" % (filename, name))
+    print "stage timings written to", filename
+
+def _reset_peak_memory():
+    #on linux the peak resident size can be reset, so each stage gets its own peak. Elsewhere the
+    #process peak so far is recorded
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except (IOError, OSError):
+        pass
+
+def _peak_memory_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except (IOError, OSError):
+        pass
+    if resource is not None:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+    return 0.0
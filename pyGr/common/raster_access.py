@@ -0,0 +1,90 @@
+import os
+import hashlib
+import numpy as np
+import rasterio
+
+DEFAULT_STRIP_HEIGHT = 256
+
+def cache_folder(Config):
+    #folder for memory mapped rasters, from the optional Input:cache_folder setting
+    if Config.has_option("Input", "cache_folder") and Config.get("Input", "cache_folder"):
+        folder = Config.get("Input", "cache_folder")
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        return folder
+    return None
+
+def cache_path(Config, name):
+    folder = cache_folder(Config)
+    if folder is None:
+        return None
+    return os.path.join(folder, name)
+
+def strips(rows, strip_height=DEFAULT_STRIP_HEIGHT):
+    #(row_start, row_end) of consecutive strips of rows
+    for row_start in xrange(0, rows, strip_height):
+        yield (row_start, min(row_start + strip_height, rows))
+
+def row_windows(dataset, min_rows=DEFAULT_STRIP_HEIGHT):
+    #((row_start, row_end), (0, width)) windows of whole rows, following the block layout of the file so each block is read once
+    block_height = dataset.block_shapes[0][0]
+    for (row_start, row_end) in strips(dataset.height, block_height * max(1, -(-min_rows // block_height))):
+        yield ((row_start, row_end), (0, dataset.width))
+
+class RasterBand:
+    '''
+    One band of a raster. Without a cache folder the band is read into memory as before.
+    With one, the band is copied strip by strip into a .npy file in the cache folder, named from the raster's
+    absolute path, size and modification time so that a changed or different raster gets its own copy, and served as a read-only memory map, so only the windows that are
+    actually used get paged in and peak memory no longer grows with the size of the study area.
+    '''
+    def __init__(self, filename, band=1, cache_folder=None):
+        with rasterio.open(filename) as src:
+            self.affine = src.affine
+            self.crs = src.crs
+            self.nodata = src.nodata
+            self.shape = (src.height, src.width)
+
+            if cache_folder is None:
+                self.array = src.read(band)
+            else:
+                self.array = cached_band(src, band, os.path.join(cache_folder, band_cache_name(filename, band)))
+
+def band_cache_name(filename, band):
+    stat = os.stat(filename)
+    key = hashlib.sha1("%s|%d|%r" % (os.path.abspath(filename), stat.st_size, stat.st_mtime)).hexdigest()[:16]
+    return "%s.%s.band%d.npy" % (os.path.splitext(os.path.basename(filename))[0], key, band)
+
+def table_cache_path(Config, raster_file, band=1, clip_min=-1):
+    #summed-area table of a band in the cache folder, named from the band's cache name and the clipping
+    folder = cache_folder(Config)
+    if folder is None:
+        return None
+    clip = "" if clip_min is None else "_clip%d" % clip_min
+    return os.path.join(folder, band_cache_name(raster_file, band)[:-len(".npy")] + ".sat%s.npy" % clip)
+
+def cached_band(src, band, cache_file):
+    #an existing copy is checked against the band, and rebuilt if it does not match
+    shape = (src.height, src.width)
+    dtype = np.dtype(src.dtypes[band - 1])
+    if os.path.exists(cache_file):
+        try:
+            cached = np.load(cache_file, mmap_mode='r')
+            if cached.shape == shape and cached.dtype == dtype:
+                return cached
+            del cached
+        except (IOError, ValueError):
+            pass
+
+    print "caching band", band, "of", src.name, "to", cache_file
+    #written under another name first, so an interrupted copy is never taken for a complete one
+    temp_file = cache_file + ".part.npy"
+    out = np.lib.format.open_memmap(temp_file, mode='w+', dtype=dtype, shape=shape)
+    for window in row_windows(src):
+        ((row_start, row_end), cols) = window
+        out[row_start:row_end] = src.read(band, window=window)
+    out.flush()
+    del out
+    os.rename(temp_file, cache_file)
+
+    return np.load(cache_file, mmap_mode='r')
@@ -1,9 +1,52 @@
 import fiona
+import numpy as np
 from shapely.geometry import mapping, shape, box
 from shapely.ops import cascaded_union
+from shapely.prepared import prep
 
 from pyGr.common.util import next_power_of_2
 
+class Regions:
+    '''
+    Region features, loaded once. Shapely geometries, prepared geometries, bounds and the union
+    boundary are cached here so that each split, prune and iteration step can reuse them.
+    Iterating or indexing gives the original features. Pickling keeps the features and the boundary,
+    the rest is prepared again when unpickled.
+    '''
+    def __init__(self, features):
+        self.features = features
+        self.geometries = [shape(f['geometry']) for f in features]
+        self.prepared = [prep(g) for g in self.geometries]
+        self.bounds = np.array([g.bounds for g in self.geometries]).reshape(-1, 4)
+        self._boundary = None
+        self._prepared_boundary = None
+
+    def __getstate__(self):
+        return {'features': self.features, 'boundary': self._boundary}
+
+    def __setstate__(self, state):
+        self.__init__(state['features'])
+        self._boundary = state['boundary']
+
+    def __len__(self):
+        return len(self.features)
+
+    def __iter__(self):
+        return iter(self.features)
+
+    def __getitem__(self, index):
+        return self.features[index]
+
+    def boundary(self):
+        if self._boundary is None:
+            self._boundary = cascaded_union(self.geometries)
+        return self._boundary
+
+    def prepared_boundary(self):
+        if self._prepared_boundary is None:
+            self._prepared_boundary = prep(self.boundary())
+        return self._prepared_boundary
+
 def load_regions(Config):
     regions_file = Config.get("Regions", "filename")
 
@@ -22,9 +65,11 @@ def load_regions(Config):
             elif f['geometry']['type'] == "Polygon":
                 regions.append(f)
 
-    return regions
+    return Regions(regions)
 
 def get_region_boundary(regions):
+    if isinstance(regions, Regions):
+        return regions.boundary()
     return cascaded_union([shape(r['geometry']) for r in regions])
 
 def get_square_envelope((rows, cols), affine):
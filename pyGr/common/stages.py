@@ -0,0 +1,117 @@
+'''
+Incremental execution of the pre-processing steps.
+
+Each Stage names the files or folders it reads and writes, and the parameters it depends on. Before
+a stage runs, a hash of the contents of its inputs and of its parameters is compared with the one
+recorded next to its outputs by the last run, and the stage is skipped if nothing has changed and all
+its outputs are there. A stage that is rebuilt changes the contents of its outputs, and so the hashes
+of the stages downstream of it, which are rebuilt in turn. A stage whose new outputs are the same as
+before does not cause anything downstream to run.
+'''
+import os
+import glob
+import json
+import hashlib
+
+class Stage:
+    def __init__(self, name, run, inputs=(), outputs=(), params=None, enabled=True):
+        self.name = name
+        self.run = run
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.params = params or {}
+        self.enabled = enabled
+
+    def record_file(self):
+        #the hash is kept next to the first output
+        return os.path.normpath(self.outputs[0]) + ".stage.json"
+
+class StageRunner:
+    '''
+    Runs a list of stages in order, skipping those that are up to date. File hashes are remembered by
+    size and modification time in hash_cache_file, so unchanged files are only read once.
+    With start, the stages before it are skipped and it and every later stage are run regardless,
+    with force every stage is run.
+    '''
+    def __init__(self, hash_cache_file, start=None, force=False):
+        self.hash_cache_file = hash_cache_file
+        self.start = start
+        self.force = force
+        self.file_hashes = {}
+        if os.path.exists(hash_cache_file):
+            with open(hash_cache_file) as f:
+                self.file_hashes = json.load(f)
+
+    def run(self, stages):
+        names = [stage.name for stage in stages]
+        if self.start is not None and self.start not in names:
+            raise ValueError("unknown start stage %s, must be one of: %s" % (self.start, ", ".join(names)))
+
+        started = self.start is None
+        for stage in stages:
+            started = started or stage.name == self.start
+            if not stage.enabled:
+                continue
+            if not started:
+                print "\nskipping", stage.name, "(before start stage)"
+                continue
+
+            stage_hash = self.stage_hash(stage)
+            if not (self.force or self.start is not None) and self.is_up_to_date(stage, stage_hash):
+                print "\n%s is up to date, skipping" % stage.name
+                continue
+
+            #the old record goes first, so a stage that fails part way is not taken as up to date next time
+            if os.path.exists(stage.record_file()):
+                os.remove(stage.record_file())
+            stage.run()
+            with open(stage.record_file(), 'w') as f:
+                json.dump({'stage': stage.name, 'hash': stage_hash}, f)
+            self.save_hash_cache()
+
+    def is_up_to_date(self, stage, stage_hash):
+        if not all(os.path.exists(output) for output in stage.outputs) or not os.path.exists(stage.record_file()):
+            return False
+        with open(stage.record_file()) as f:
+            return json.load(f).get('hash') == stage_hash
+
+    def stage_hash(self, stage):
+        h = hashlib.sha1()
+        h.update(stage.name)
+        h.update(json.dumps(stage.params, sort_keys=True))
+        for path in stage.inputs:
+            h.update(path)
+            for (filename, file_hash) in self.path_hashes(path):
+                h.update(os.path.relpath(filename, os.path.dirname(os.path.normpath(path))))
+                h.update(file_hash)
+        return h.hexdigest()
+
+    def path_hashes(self, path):
+        #(file, hash) of every file in a folder, a file, or the parts of a shapefile (same name, any extension)
+        if os.path.isdir(path):
+            filenames = [os.path.join(root, f) for (root, dirs, files) in os.walk(path) for f in files
+                         if not f.endswith(".stage.json")]
+        elif os.path.isfile(path) and not path.endswith(".shp"):
+            filenames = [path]
+        else:
+            filenames = [f for f in glob.glob(os.path.splitext(path)[0] + ".*")
+                         if not f.endswith(".stage.json")] if path.endswith(".shp") else []
+        return [(filename, self.file_hash(filename)) for filename in sorted(filenames)]
+
+    def file_hash(self, filename):
+        stat = os.stat(filename)
+        key = os.path.abspath(filename)
+        cached = self.file_hashes.get(key)
+        if cached and cached[0] == stat.st_size and cached[1] == stat.st_mtime:
+            return cached[2]
+
+        h = hashlib.sha1()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        self.file_hashes[key] = [stat.st_size, stat.st_mtime, h.hexdigest()]
+        return h.hexdigest()
+
+    def save_hash_cache(self):
+        with open(self.hash_cache_file, 'w') as f:
+            json.dump(self.file_hashes, f)
@@ -1,5 +1,8 @@
 
 import math
+import os
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
 
 def roundup_to_multiple_of(x, v):
      return x if x % v == 0 else x + v - x % v
@@ -19,3 +22,39 @@ def check_and_display_results(results):
     print "\t difference:", "{:,}".format(sum(actuals) - sum(calcd))
 
     print "\t RMSE:", "{:,}".format(math.sqrt(sum([(a-b)**2 for (a,b) in results]) / len(results)))
+
+def is_up_to_date(outputs, inputs):
+    #True if all outputs exist and none is older than any of the inputs
+    if not all(os.path.exists(f) for f in outputs):
+        return False
+    return min(os.path.getmtime(f) for f in outputs) >= max([os.path.getmtime(f) for f in inputs] or [0])
+
+def _run_district((function, district, args)):
+    try:
+        function(*args)
+        return (district, None)
+    except Exception as e:
+        return (district, "%s: %s" % (type(e).__name__, e))
+
+def run_districts(function, district_args, processes=1, threads=False):
+    '''
+    Call function(*args) for each (district, args), in a pool of up to processes workers (threads, for
+    functions that wait on a subprocess). A district that fails does not stop the others, the errors of
+    all failed districts are raised together at the end.
+    '''
+    tasks = [(function, district, args) for (district, args) in district_args]
+    if processes > 1 and len(tasks) > 1:
+        pool = (ThreadPool if threads else Pool)(min(processes, len(tasks)))
+        try:
+            results = pool.map(_run_district, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [_run_district(task) for task in tasks]
+
+    errors = [(district, error) for (district, error) in results if error is not None]
+    for (district, error) in errors:
+        print "\tdistrict", district, "failed:", error
+    if errors:
+        raise Exception("%d of %d districts failed: %s" % (len(errors), len(tasks), ", ".join(d for (d, e) in errors)))
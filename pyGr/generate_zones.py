@@ -1,9 +1,9 @@
-import sys, os
+import sys, os, time
 from pyGr.zoning_algorithm import octtree
 import ConfigParser
 import rasterio
-from pyGr.common import region_ops
-from pyGr.zoning_algorithm import iteration, helper_functions, tabulation
+from pyGr.common import region_ops, raster_access, profiling
+from pyGr.zoning_algorithm import iteration, helper_functions, tabulation, zone_cache
 from pyGr.common import config
 
 
@@ -13,31 +13,48 @@ if __name__ == "__main__":
     if len(sys.argv) == 1 or not os.path.exists(sys.argv[1]):
         raise IOError("please supply a configuration file as a program arugment")
     Config.read(sys.argv[1])
+    start_time = time.time()
+    if Config.has_option("Output", "profile_stages") and Config.get("Output", "profile_stages"):
+        profiling.configure([name.strip() for name in Config.get("Output", "profile_stages").split(",")])
 
     with rasterio.open(Config.get("Input", "combined_raster")) as r:
-        raster_array = r.read(1)
         transform = r.affine
         zonesSaptialRef = r.crs.to_dict()
 
         regions = region_ops.load_regions(Config)
-        boundary = region_ops.get_region_boundary(regions)
-        envelope = region_ops.get_square_envelope(raster_array.shape, transform)
-
-        region_octtree = octtree.OcttreeNode(envelope, None, None)
 
         if Config.get("Parameters", "mode") == 'Trend':
-                region_octtree = iteration.model_zones_vs_threshold(Config, region_octtree, regions, raster_array, r.affine)
+                raster_array = raster_access.RasterBand(Config.get("Input", "combined_raster"),
+                                                        cache_folder=raster_access.cache_folder(Config)).array
+                region_octtree = iteration.model_zones_vs_threshold(Config, regions, raster_array, r.affine)
         else:
-            if Config.get("Parameters", "mode") == 'Iterative':
-                region_octtree = iteration.solve_iteratively(Config, region_octtree, regions, raster_array, r.affine)
-            if Config.get("Parameters", "mode") == 'Once':
-                pop_threshold =  Config.getint("Parameters", "population_threshold")
-                region_octtree = octtree.build_out_nodes(Config, region_octtree, regions, raster_array, r.affine, pop_threshold)
+            #zones of an earlier run with the same rasters, regions and parameters are reused
+            zone_cache_file = zone_cache.cache_file(Config)
+            region_octtree = zone_cache.load(zone_cache_file, regions)
+
+            if region_octtree is None:
+                #memory mapped rather than read into memory when a cache folder is configured
+                raster_array = raster_access.RasterBand(Config.get("Input", "combined_raster"),
+                                                        cache_folder=raster_access.cache_folder(Config)).array
+
+                if Config.get("Parameters", "mode") == 'Iterative':
+                    region_octtree = iteration.solve_iteratively(Config, regions, raster_array, r.affine)
+                if Config.get("Parameters", "mode") == 'Once':
+                    pop_threshold =  Config.getint("Parameters", "population_threshold")
+                    region_octtree = octtree.build_out_nodes(Config, regions, raster_array, r.affine, pop_threshold)
 
-            helper_functions.calculate_final_values(Config, region_octtree)
+                helper_functions.calculate_final_values(Config, region_octtree)
+                if zone_cache_file is not None:
+                    zone_cache.save(zone_cache_file, region_octtree)
 
 
             output_file = Config.get("Output", "filename")
+            if Config.has_option("Output", "format") and Config.get("Output", "format") == 'gpkg':
+                save_zones = helper_functions.save_geopackage
+                if not output_file.endswith(".gpkg"):
+                    output_file += ".gpkg"
+            else:
+                save_zones = helper_functions.save
 
             if Config.getboolean("Land Use", "calculate_land_use"):
                 lu_config = config.LandUseConfig(sys.argv[2])
@@ -45,11 +62,15 @@ if __name__ == "__main__":
                 shapefiles = lu_config.shapefiles
                 #get land use values from config
                 field_values = lu_config.translations
-                tabulation.run_tabulate_intersection(region_octtree, shapefiles, class_field, field_values)
-                helper_functions.save(output_file, zonesSaptialRef, region_octtree, include_land_use=True, field_values=field_values)
+                if Config.has_option("Land Use", "land_use_raster") and Config.get("Land Use", "land_use_raster"):
+                    tabulation.run_tabulate_raster(region_octtree, Config.get("Land Use", "land_use_raster"), field_values)
+                else:
+                    processes = Config.getint("Land Use", "processes") if Config.has_option("Land Use", "processes") else 1
+                    tabulation.run_tabulate_intersection(region_octtree, shapefiles, class_field, field_values, processes)
+                save_zones(output_file, zonesSaptialRef, region_octtree, include_land_use=True, field_values=field_values)
 
             else:
-                helper_functions.save(output_file, zonesSaptialRef, region_octtree)
+                save_zones(output_file, zonesSaptialRef, region_octtree)
 
             if Config.getboolean('Regions', 'validate_zones'):
                 identifier = Config.get('Regions', 'identifier')
@@ -57,3 +78,8 @@ if __name__ == "__main__":
                 emp_field = Config.get('Regions', 'employment_field')
                 helper_functions.validate_zones( Config.get("Regions", "filename"), identifier, pop_field, emp_field, output_file)
 
+            if not Config.has_option("Output", "timings") or Config.getboolean("Output", "timings"):
+                profiling.write(os.path.splitext(output_file)[0] + ".timings.json", mode=Config.get("Parameters", "mode"),
+                                threshold=region_octtree.threshold, zones=region_octtree.count(),
+                                seconds=time.time() - start_time)
+
@@ -19,55 +19,70 @@
 import numpy as np
 import rasterio
 from affine import Affine
-from skimage.util import view_as_blocks
-
-def disaggregate(m10_data, ratio, bands):
+from pyGr.common.raster_access import strips
+
+def disaggregate(m10_data, ratio, bands, mask=None):
+    '''
+    Count the cells of each land use class (1 to bands) in every (ratio x ratio) block, returning an
+    array of (bands, block rows, block cols). The edges are padded with 0 (no class) up to a whole block.
+    Each class is counted by summing a boolean mask block by block, so the temporaries take a byte a cell.
+    mask, if given, is a boolean buffer of the padded shape that is reused between calls.
+    '''
     assert(isinstance(ratio, int))
 
     (height, width) = m10_data.shape
-    left_padding = ratio - (width % ratio)
-    bottom_padding = ratio - (height % ratio)
-    m10_padded = np.pad(m10_data, ((0,bottom_padding),(0,left_padding)), mode='constant', constant_values=0)
-
-    blocked_a = view_as_blocks(m10_padded, (ratio,ratio))
-
-    (cols, rows) = blocked_a.shape[:2]
-    land_use_array = np.zeros((cols, rows, bands), dtype=np.ubyte)
-
-    for i in range(blocked_a.shape[0]):
-        for j in range(blocked_a.shape[1]):
-            bin_counts = np.bincount(blocked_a[i][j].ravel(), minlength=bands+1)
-            land_use_array[i,j] = bin_counts[1:] #exclude zero counts
-
-    return np.rollaxis(land_use_array, 2, 0)
-
-def run_land_use_aggregation(input_file, bands, output_file, output_resolution):
+    (block_rows, block_cols) = (-(-height // ratio), -(-width // ratio))
+    if (height, width) != (block_rows * ratio, block_cols * ratio):
+        padded = np.zeros((block_rows * ratio, block_cols * ratio), dtype=m10_data.dtype)
+        padded[:height, :width] = m10_data
+        m10_data = padded
+    if mask is None:
+        mask = np.empty(m10_data.shape, dtype=bool)
+
+    #codes outside 1 to bands are not counted. A block holds at most ratio * ratio cells of a class
+    land_use_array = np.empty((bands, block_rows, block_cols), dtype=np.ubyte)
+    for k in xrange(bands):
+        np.equal(m10_data, k + 1, out=mask)
+        land_use_array[k] = mask.reshape(block_rows, ratio, block_cols, ratio).sum(axis=(1, 3), dtype=np.uint16)
+    return land_use_array
+
+def run_land_use_aggregation(input_file, bands, output_file, output_resolution, strips_rows=512):
     with rasterio.open(input_file, 'r') as land_use_raster:
 
         affine_fine = land_use_raster.profile['affine']
         profile = land_use_raster.profile
 
-        m10_data, = land_use_raster.read()
-
         ratio = int(output_resolution / affine_fine.a)
 
         affine_gross = affine_fine * Affine.scale(ratio)
 
-        land_use_array = disaggregate(m10_data, ratio, bands)
-
-        (num_bands, new_array_height, new_array_width) = land_use_array.shape
+        (height, width) = (land_use_raster.height, land_use_raster.width)
+        (new_array_height, new_array_width) = (-(-height // ratio), -(-width // ratio))
 
-        profile.update(dtype=land_use_array.dtype,
-                       count=num_bands,
+        profile.update(dtype=np.ubyte,
+                       count=bands,
                        transform=affine_gross,
                        nodata = 0,
                        height = new_array_height,
                        width = new_array_width)
 
+        #the 10m raster is read a strip of whole blocks at a time, and each aggregated strip written out.
+        #The strip, padded to whole blocks, and the class mask are kept in buffers reused for every strip
+        strip_height = ratio * max(1, strips_rows // ratio)
+        padded = np.zeros((strip_height, new_array_width * ratio), dtype=land_use_raster.dtypes[0])
+        mask = np.empty(padded.shape, dtype=bool)
         with rasterio.open(output_file, 'w', **profile) as out:
-            print land_use_array.shape , "->", (out.height, out.width)
-            for k in xrange(0,num_bands):
-                out.write(land_use_array[k], indexes=k+1)
+            print (height, width), "->", (out.height, out.width)
+            for (row_start, row_end) in strips(height, strip_height):
+                rows = row_end - row_start
+                padded_rows = -(-rows // ratio) * ratio
+                padded[:rows, :width] = land_use_raster.read(1, window=((row_start, row_end), (0, width)))
+                padded[rows:padded_rows] = 0
+                land_use_array = disaggregate(padded[:padded_rows], ratio, bands, mask[:padded_rows])
+                out_start = row_start // ratio
+                window = ((out_start, out_start + land_use_array.shape[1]), (0, new_array_width))
+                for k in xrange(0,bands):
+                    out.write(land_use_array[k], indexes=k+1, window=window)
 
 if __name__ == "__main__":
     output_resolution = 100
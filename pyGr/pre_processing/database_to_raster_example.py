@@ -1,26 +1,44 @@
 from affine import Affine
-import pyGr.util as util
+from pyGr.common import config
 import rasterio
 from rasterio.warp import reproject, Resampling
 from fiona.crs import from_epsg
 import pyproj
 import numpy as np
-import psycopg2
 import os
+import sys
 
 
-def load_data2(Config, min_x, min_y, max_x, max_y):
+def connect(Config):
+    import psycopg2
     database_string = Config.get("Input", "databaseString")
     if database_string:
-        conn = psycopg2.connect(None, "arcgis", "postgres", "postgres")
+        return psycopg2.connect(None, "arcgis", "postgres", "postgres")
     else:
         db = Config.get("Input", "database")
         user = Config.get("Input", "user")
         pw = Config.get("Input", "password")
         host = Config.get("Input", "host")
 
-        conn = psycopg2.connect(database=db, user=user, password=pw, host=host)
-    cursor = conn.cursor()
+        return psycopg2.connect(database=db, user=user, password=pw, host=host)
+
+def streaming_cursor(conn, name="grid_ingest", chunk_size=100000):
+    #server side (named) cursor on postgres, so rows are sent a chunk at a time rather than all at once
+    if type(conn).__module__.startswith("psycopg2"):
+        cursor = conn.cursor(name)
+        cursor.itersize = chunk_size
+        return cursor
+    return conn.cursor()
+
+def load_data2(Config, min_x, min_y, max_x, max_y, conn=None, chunk_size=100000):
+    '''
+    Load the grid cells with their centre in the bounds into an int32 array, returned with its affine.
+    Rows are fetched chunk_size at a time into numpy arrays and placed with index arithmetic, so memory
+    is the grid plus one chunk. conn is any DB-API connection (ie: sqlite3 for testing), postgres by default.
+    '''
+    if conn is None:
+        conn = connect(Config)
+    cursor = streaming_cursor(conn, chunk_size=chunk_size)
 
     sql = """SELECT {sql_x}, {sql_y}, {sql_value}
             FROM {sql_table}
@@ -29,52 +47,56 @@ def load_data2(Config, min_x, min_y, max_x, max_y):
                        sql_y = Config.get("Sql", "y"),
                        sql_value = Config.get("Sql", "value"),
                        sql_table = Config.get("Sql", "table"))
+    if sys.modules[type(conn).__module__.split(".")[0]].paramstyle == "qmark":
+        sql = sql.replace("%s", "?")
 
     resolution = Config.getint("Input", "resolution")
 
     print "parameters", (min_x, max_x, min_y, max_y)
     cursor.execute(sql, (min_x, max_x, min_y, max_y)) #xmin xmax, ymin, ymax in that order
-    #ttes charhra
-
-    records = cursor.fetchall()
-    x_vals = zip(*records)[0]
-    y_vals = zip(*records)[1]
-    count_rows = len(set(y_vals))
-    count_cols = len(set(x_vals))
-    db_min_x = min(x_vals)
-    db_min_y = min(y_vals)
-
-    print (count_rows, count_cols, db_min_x, db_min_y)
-
-
-    pop_array = np.zeros((count_rows, count_cols), dtype=np.int32)
 
+    pop_array = None
+    while True:
+        records = cursor.fetchmany(chunk_size)
+        if not records:
+            break
+        (x, y, value) = np.array(records, dtype=np.float64).T
+
+        if pop_array is None:
+            #x and y mark cell centres. The grid is every cell with its centre in the bounds, lined up with the first one
+            (centre_x, centre_y) = (x[0], y[0])
+            first_x = centre_x + np.ceil((min_x - centre_x) / resolution) * resolution
+            last_x = centre_x + np.floor((max_x - centre_x) / resolution) * resolution
+            first_y = centre_y + np.ceil((min_y - centre_y) / resolution) * resolution
+            last_y = centre_y + np.floor((max_y - centre_y) / resolution) * resolution
+            count_cols = int(round((last_x - first_x) / resolution)) + 1
+            count_rows = int(round((last_y - first_y) / resolution)) + 1
+            print (count_rows, count_cols, first_x, first_y)
+            pop_array = np.zeros((count_rows, count_cols), dtype=np.int32)
+
+        #reference arrays by (row_no , col_no), rows from the top
+        cols = np.round((x - first_x) / resolution).astype(np.int64)
+        rows = np.round((last_y - y) / resolution).astype(np.int64)
+        keep = value > 0
+        pop_array[rows[keep], cols[keep]] = value[keep]
+
+    cursor.close()
+
+    if pop_array is None:
+        print "no cells found"
+        (first_x, last_y) = (min_x + resolution / 2.0, max_y - resolution / 2.0)
+        pop_array = np.zeros((0, 0), dtype=np.int32)
 
     a = Affine(
             resolution,
             0,
-            db_min_x, #shift from the center marking to bottom left corner
+            first_x - resolution / 2.0, #shift from the center marking to the cell's top left corner
             0,
             -resolution,
-            db_min_y + count_rows*resolution #shift from the center marking to bottom left corner
+            last_y + resolution / 2.0
     )
 
-    print "array origins: ", (db_min_x, db_min_y)
-
-
-    for line in records:
-        if line[2] > 0:
-            (x,y) = (line[0], line[1])
-            #print "(x,y): ", (x,y)
-            (col, row) = ~a * (x,y)
-            try:
-                pop_array[row, col] = line[2]
-            except IndexError:
-                print "(col,row): ", (col, row), "x,y:", (x,y)
-
-        #reference arrays by (row_no , col_no)
-        #reference arrays by (   a_y,      a_x   )
-
+    print "array origins: ", (a.c, a.f)
     print np.sum(pop_array)
 
     return (pop_array, a)
@@ -132,7 +154,7 @@ def calculate_study_area_offsets(region_id_file, population_crs, resolution):
 
 if __name__ == "__main__":
 
-    Config = util.load_config("config/database_config.ini")
+    Config = config.load_config("config/database_config.ini")
     region_id_file = "data/temp/region_id_100m.tif"
     pop_raster_file = "data/temp/population_zensus_raster.tiff"
 
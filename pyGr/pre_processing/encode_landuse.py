@@ -1,9 +1,11 @@
 import fiona
 from fiona.crs import to_string
-import os, subprocess
+import os, subprocess, shutil
+from pyGr.common.util import is_up_to_date, run_districts
 
 #new shapefile with landuse types coverted to integer codes (needed for gdal_rasterize
 def codify_shapefile_landuse(land_use_config, shapefile, new_folder_path_abs, shapefile_name):
+    shutil.rmtree(new_folder_path_abs, ignore_errors=True)
     os.mkdir(new_folder_path_abs)
     full_new_path = os.path.join(new_folder_path_abs, shapefile_name + ".shp")
     land_use_encoding = land_use_config.encodings
@@ -29,8 +31,13 @@ def codify_shapefile_landuse(land_use_config, shapefile, new_folder_path_abs, sh
     return full_new_path
 
 #go through land use shapefiles, and codify each one. TODO:Generalise for non ALKIS Data
-def encode_shapefiles(land_use_config, land_use_folder, new_land_use_folder):
-    for ags_district in os.listdir(land_use_folder):
+def encode_shapefiles(land_use_config, land_use_folder, new_land_use_folder, processes=1, skip_up_to_date=False):
+    '''
+    Districts are encoded in up to processes worker processes. With skip_up_to_date, districts whose encoded
+    shapefile is newer than both their shapefile and the land use configuration are not encoded again
+    '''
+    district_args = []
+    for ags_district in sorted(os.listdir(land_use_folder)):
         folder_abs = os.path.join(land_use_folder, ags_district)
         new_shape_file_name = ags_district
         if os.path.isdir(folder_abs):
@@ -44,4 +51,11 @@ def encode_shapefiles(land_use_config, land_use_folder, new_land_use_folder):
 
             new_folder_path_abs = os.path.join(new_land_use_folder, ags_district)
 
-            codify_shapefile_landuse(land_use_config, full_sp_path, new_folder_path_abs, new_shape_file_name)
+            inputs = [os.path.join(folder_abs, f) for f in os.listdir(folder_abs)
+                      if os.path.splitext(f)[0] == seidlung_path] + [land_use_config.filename]
+            if skip_up_to_date and is_up_to_date([os.path.join(new_folder_path_abs, new_shape_file_name + ".shp")], inputs):
+                print ags_district, "is up to date, skipping"
+            else:
+                district_args.append((ags_district, (land_use_config, full_sp_path, new_folder_path_abs, new_shape_file_name)))
+
+    run_districts(codify_shapefile_landuse, district_args, processes)
@@ -7,10 +7,17 @@ from rasterio.merge import merge as merge_tool
 from fiona.crs import to_string
 import subprocess
 from affine import Affine
+from pyGr.common.raster_access import row_windows
+from pyGr.common.util import is_up_to_date, run_districts
 
 #for each land use shapefile, create a raster, save to a folder
-def create_land_use_rasters(land_use_folder, raster_output_folder, crs = None):
-    for ags_district in os.listdir(land_use_folder):
+def create_land_use_rasters(land_use_folder, raster_output_folder, crs = None, processes = 1, skip_up_to_date = False):
+    '''
+    gdal_rasterize runs for up to processes districts at once. With skip_up_to_date, districts whose raster
+    is newer than their shapefile are not rasterized again
+    '''
+    district_args = []
+    for ags_district in sorted(os.listdir(land_use_folder)):
         folder_abs = os.path.join(land_use_folder, ags_district)
         if os.path.isdir(folder_abs):
             #find siedlung shapefile name
@@ -21,6 +28,7 @@ def create_land_use_rasters(land_use_folder, raster_output_folder, crs = None):
             #for each land use shapefile, tabulate intersections for each zone in that shapefile
             full_sp_path = os.path.join(folder_abs, shapefile)
             layer_name = os.path.splitext(shapefile)[0]
+            output_file = os.path.join(raster_output_folder, ags_district + "_" + layer_name + '.tif')
             with fiona.open(full_sp_path, 'r') as vector_f:
                 assert crs or vector_f.crs, "a CRS must be specified either in in the shapefile or as an argument"
                 if not crs:
@@ -42,11 +50,20 @@ def create_land_use_rasters(land_use_folder, raster_output_folder, crs = None):
                                   "-l",
                                   layer_name,
                                   full_sp_path,
-                                  os.path.join(raster_output_folder, ags_district + "_" + layer_name + '.tif')]
+                                  output_file]
 
-                print(cmd)
+            shapefile_parts = [os.path.join(folder_abs, f) for f in os.listdir(folder_abs)
+                               if os.path.splitext(f)[0] == layer_name]
+            if skip_up_to_date and is_up_to_date([output_file], shapefile_parts):
+                print ags_district, "is up to date, skipping"
+                continue
+            if os.path.exists(output_file):
+                os.remove(output_file)
+            print(cmd)
+            district_args.append((ags_district, (cmd,)))
 
-                subprocess.check_call(cmd)
+    #the work is done by gdal in a subprocess, so threads are enough to run districts in parallel
+    run_districts(subprocess.check_call, district_args, processes, threads=True)
 
 #create region_id raster
 def create_ags_code_raster(regions_shapefile, raster_template, out_filename, resolution):
@@ -84,10 +101,13 @@ def clip_land_use_raster(land_use_raster, region_shapefile, output_file):
             #TODO: need to transform the affine for new clipping
             (min_col, min_row) = map(int, ~a * (w, n))
             (max_col, max_row) = map(int, ~a * (e, s))
+            #keep the window within the raster, as a read of it would be
+            (min_col, min_row) = (max(min_col, 0), max(min_row, 0))
+            (max_col, max_row) = (min(max_col, r.width), min(max_row, r.height))
             w2, n2 = a * (min_col, min_row)
             new_affine = Affine.from_gdal(w2, 100, 0.0, n2, 0.0, -100)
 
-            (height,width) = r.read(1, window = ((min_row, max_row), (min_col, max_col))).shape
+            (height, width) = (max_row - min_row, max_col - min_col)
 
             profile = r.profile
             profile.update({
@@ -99,10 +119,12 @@ def clip_land_use_raster(land_use_raster, region_shapefile, output_file):
 
             with rasterio.open(output_file, 'w', **profile) as out:
 
-                for i in r.indexes:
-                    clipped = r.read(i, window = ((min_row, max_row), (min_col, max_col)))
-                    #print clipped.shape
-                    out.write(clipped, indexes = i)
+                #copied a strip of rows at a time
+                for ((row_start, row_end), cols) in row_windows(out):
+                    window = ((min_row + row_start, min_row + row_end), (min_col, max_col))
+                    for i in r.indexes:
+                        clipped = r.read(i, window = window)
+                        out.write(clipped, indexes = i, window = ((row_start, row_end), cols))
 
 
 #merge rasters from folder into a single raster. #TODO: make it detect windows or osx automatically
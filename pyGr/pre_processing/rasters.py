@@ -16,6 +16,8 @@ import fiona
 import numpy as np
 import rasterstats
 from pyGr.common.util import check_and_display_results
+from pyGr.common.raster_access import row_windows
+from pyGr.pre_processing.statistics import extract_region_value, region_positions, region_sums
 
 def build_pop_raster(region_shapefile, pop_density_raster_file, region_raster_file, output_file, scale_factors):
     build_region_density_raster(region_shapefile, "population", pop_density_raster_file, region_raster_file, output_file, scale_factors)
@@ -30,36 +32,22 @@ def build_region_density_raster(region_shapefile, name, value_raster_file, regio
         with rasterio.open(region_raster_file, 'r') as region_raster:
 
                 (region_code_array,) = region_raster.read()
+                (rows, cols) = region_code_array.shape
 
-                num_bands = len(scale_factors)
-                density_arrays = []
-
-                for i,f in enumerate(scale_factors):
-                    #clip values so that smallest value is positive
-                    value_array = np.clip(value_raster.read(i+1), 0, None)
-
-                    zs = rasterstats.zonal_stats(region_shapefile,
-                                                 value_array,
-                                                 affine=value_raster.affine,
-                                                 band=i+1,
-                                                 stats=['sum', 'count'],
-                                                 geojson_out=True)
-
-                    region_value_sums = {z['properties']['AGS_Int']: z['properties'] for z in zs}
-
-                    density_array = np.zeros(value_array.shape)
-
-                    #for each land use band
-                    for (row,col), v in np.ndenumerate(value_array):
-                        try:
-                            region_id = int(region_code_array[row,col])
-                            region_sum = region_value_sums[region_id]['sum']
-                            density_array[row, col] = (float(value_array[row, col]) / region_sum) * f
+                #cells are matched by row and column from the top left, as the rasters should align. Where the
+                #sizes differ only the overlap is used, and region cells beyond the value raster get a density of 0
+                overlap = ((0, min(rows, value_raster.height)), (0, min(cols, value_raster.width)))
+                if (value_raster.height, value_raster.width) != (rows, cols):
+                    print "warning: %s is %d x %d cells but %s is %d x %d, only the overlapping %d x %d cells are used" % (
+                        value_raster_file, value_raster.height, value_raster.width, region_raster_file, rows, cols,
+                        overlap[0][1], overlap[1][1])
 
-                        except (KeyError, IndexError, TypeError, ZeroDivisionError):
-                            density_array[row, col] = 0
+                #per region sums are taken over the cells of the region id raster, in one bincount per band
+                region_codes = np.array(sorted(extract_region_value(region_shapefile, 'AGS_Int')))
+                positions = region_positions(region_code_array, region_codes)
+                inside = positions >= 0
 
-                    density_arrays.append(density_array)
+                num_bands = len(scale_factors)
 
                 profile = region_raster.profile
                 profile.update(dtype=rasterio.float64)
@@ -67,41 +55,60 @@ def build_region_density_raster(region_shapefile, name, value_raster_file, regio
                 print "Writing", name, "to: ", output_file
                 print profile
                 with rasterio.open(output_file, 'w', **profile) as out:
-                    for band in range(num_bands):
-                        out.write(density_arrays[band], indexes=band+1)
-
-def build_simple_employment_raster(region_shapefile, name, region_raster_file, output_file):
-        with rasterio.open(region_raster_file, 'r') as region_raster:
-            with fiona.open(region_shapefile) as regions:
-
-                (region_code_array,) = region_raster.read()
 
-                zs = rasterstats.zonal_stats(region_shapefile,
-                                                 region_code_array,
-                                                 affine=region_raster.affine,
-                                                 band=1,
-                                                 stats=['count'],
-                                                 geojson_out=True)
-
-                region_cell_count = {z['properties']['AGS_Int']: z['properties']['count'] for z in zs}
-                region_emp = {r['properties']['AGS_Int']: r['properties']['emp_2008'] for r in regions}
-                density_array = np.zeros(region_code_array.shape)
-
-                for (row,col), v in np.ndenumerate(region_code_array):
-                    try:
-                        region_id = int(region_code_array[row,col])
-                        density_array[row, col] = region_emp[region_id] / region_cell_count[region_id]
-
-                    except (KeyError, IndexError, TypeError, ZeroDivisionError):
-                        density_array[row, col] = 0
-
-
-                profile = region_raster.profile
-                profile.update(dtype=rasterio.float64)
-                print "Writing", name, "to: ", output_file
-                print profile
-                with rasterio.open(output_file, 'w', **profile) as out:
-                    out.write(density_array, indexes=1)
+                    #each density band is written as soon as it is built, so only one is held in memory
+                    for i,f in enumerate(scale_factors):
+                        #clip values so that smallest value is positive
+                        value_array = np.zeros((rows, cols))
+                        value_array[:overlap[0][1], :overlap[1][1]] = np.clip(value_raster.read(i+1, window=overlap), 0, None)
+                        region_value_sums = region_sums(positions, value_array, len(region_codes))
+
+                        #share of the region's sum in each cell, scaled. 0 outside the regions or where a region sums to 0
+                        cell_region_sum = np.where(inside, region_value_sums[positions], 0)
+                        density_array = np.zeros(value_array.shape)
+                        np.divide(value_array, cell_region_sum, out=density_array, where=cell_region_sum > 0)
+                        density_array *= f
+
+                        out.write(density_array, indexes=i+1)
+
+def build_simple_employment_raster(region_shapefile, name, region_raster_file, output_file, emp_fields):
+    '''
+    Spread a regional statistic evenly over the cells of each region. emp_fields is a field of the region
+    shapefile, or a list of fields (ie: several years) to write as one band each. The region id raster is read
+    in strips of rows, twice: once to count the cells of each region, with a bincount per strip, and once to
+    write the values, so only a strip is held in memory.
+    '''
+    if isinstance(emp_fields, basestring):
+        emp_fields = [emp_fields]
+
+    with rasterio.open(region_raster_file, 'r') as region_raster:
+        with fiona.open(region_shapefile) as regions:
+            region_properties = {r['properties']['AGS_Int']: r['properties'] for r in regions}
+        region_codes = np.array(sorted(region_properties))
+        windows = list(row_windows(region_raster))
+
+        region_cell_count = np.zeros(len(region_codes), dtype=np.int64)
+        for window in windows:
+            positions = region_positions(region_raster.read(1, window=window), region_codes)
+            region_cell_count += np.bincount(positions[positions >= 0], minlength=len(region_codes))
+
+        #value per cell of each region and field, 0 for regions without a value or without cells
+        region_density = np.zeros((len(emp_fields), len(region_codes)))
+        for (band, emp_field) in enumerate(emp_fields):
+            region_emp = np.array([region_properties[code][emp_field] or 0 for code in region_codes], dtype=np.float64)
+            np.divide(region_emp, region_cell_count, out=region_density[band], where=region_cell_count > 0)
+
+        profile = region_raster.profile
+        profile.update(dtype=rasterio.float64)
+        profile.update(count=len(emp_fields))
+        print "Writing", name, "to: ", output_file
+        print profile
+        with rasterio.open(output_file, 'w', **profile) as out:
+            for window in windows:
+                positions = region_positions(region_raster.read(1, window=window), region_codes)
+                inside = positions >= 0
+                for band in xrange(len(emp_fields)):
+                    out.write(np.where(inside, region_density[band][positions], 0), indexes=band+1, window=window)
 
 def check_raster_output(region_shapefile, stats_raster, fields):
     zs = rasterstats.zonal_stats(region_shapefile, stats_raster, stats=['sum'])
@@ -127,6 +134,7 @@ def add_rasters(a_file,b_file, outputfile):
         with rasterio.open(b_file) as b:
             profile = a.profile
             with rasterio.open(outputfile, 'w', **profile) as out:
-                c = a.read(1) + b.read(1)
-                out.write(c, indexes=1)
+                for window in row_windows(a):
+                    c = a.read(1, window=window) + b.read(1, window=window)
+                    out.write(c, indexes=1, window=window)
 
@@ -7,25 +7,25 @@ def distribute_region_statistics(region_shapefile, key, density_raster_file, reg
     with rasterio.open(density_raster_file, 'r') as density_raster:
         with rasterio.open(region_raster_file, 'r') as region_raster:
                 region_stats = extract_region_value(region_shapefile, key)
-
-                density_array_list = list(density_raster.read())
+                region_codes = np.array(sorted(region_stats))
+                #regions without a value for the statistic add nothing
+                region_values = np.array([region_stats[code] or 0 for code in region_codes], dtype=np.float64)
 
                 (region_code_array,) = region_raster.read()
                 print "region code array shape: ", region_code_array.shape
                 print "region height:", region_raster.profile['height']
 
-                regional_value_a = np.zeros(density_array_list[0].shape)
+                #each cell's regional value, looked up for all cells at once. 0 outside the regions
+                positions = region_positions(region_code_array, region_codes)
+                regional_value_a = np.where(positions >= 0, region_values[positions], 0)
                 print "region_value:", regional_value_a.shape, regional_value_a.dtype
 
-                #for each land use band
-                for (row,col), v in np.ndenumerate(region_code_array):
-                    try:
-                        region_id = int(region_code_array[row,col])
-                        regional_value_a[row, col] = region_stats[region_id]
-                    except KeyError:
-                        regional_value_a[row, col] = 0
-
-                result_a = sum([regional_value_a * d_a for d_a in density_array_list])
+                #weighted density bands are added into one buffer, reading one band at a time
+                result_a = np.zeros(regional_value_a.shape)
+                for band in density_raster.indexes:
+                    density_a = density_raster.read(band).astype(np.float64)
+                    density_a *= regional_value_a
+                    result_a += density_a
 
                 profile = region_raster.profile
                 profile.update(dtype=rasterio.float64)
@@ -41,6 +41,25 @@ def extract_region_value(region_shapefile, key):
         stat_dict = {r['properties']['AGS_Int']:r['properties'][key] for r in region_features}
     return stat_dict
 
+def region_positions(region_code_array, region_codes):
+    '''
+    Position of each cell's region code in the sorted array region_codes, or -1 where the code
+    (ie: nodata) is not one of them. Lets per region values be looked up or summed for all cells at once.
+    '''
+    region_codes = np.asarray(region_codes)
+    positions = np.searchsorted(region_codes, region_code_array)
+    positions = np.clip(positions, 0, max(len(region_codes) - 1, 0))
+    if len(region_codes):
+        found = region_codes[positions] == region_code_array
+    else:
+        found = np.zeros(positions.shape, dtype=bool)
+    return np.where(found, positions, -1)
+
+def region_sums(positions, values, num_regions):
+    #sum of values in each region, cells outside every region (position -1) are left out
+    inside = positions >= 0
+    return np.bincount(positions[inside], weights=values[inside], minlength=num_regions)
+
 def build_region_stats_lookup_table(region_shapefile):
 
     with fiona.open(region_shapefile, 'r') as region_features:
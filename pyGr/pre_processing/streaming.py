@@ -0,0 +1,140 @@
+'''
+Streaming mode for the population and employment rasters.
+
+build_region_density_raster, distribute_region_statistics and add_rasters each read whole rasters,
+and hold several float64 copies of them. Here the same chain runs over aligned strips of rows instead:
+one pass collects the per region sums each density band needs, and a second pass builds the density,
+distributed and merged blocks strip by strip, writing each as it is done. Memory is bounded by the
+strip height rather than the study area, and a reader thread fetches the next strip while the current
+one is computed. The output rasters are those of the whole raster functions, up to the rounding of
+region sums that are now added strip by strip.
+'''
+import threading
+import Queue
+import sys
+from itertools import izip
+
+import numpy as np
+import rasterio
+
+from pyGr.common.raster_access import row_windows
+from pyGr.pre_processing.statistics import extract_region_value, region_positions
+
+def prefetch(blocks, depth=2):
+    #iterate blocks from a reader thread, up to depth blocks ahead. Errors are raised in the caller
+    queue = Queue.Queue(depth)
+    done = object()
+    error = []
+
+    def fill():
+        try:
+            for block in blocks:
+                queue.put(block)
+        except Exception:
+            error.append(sys.exc_info())
+        finally:
+            queue.put(done)
+
+    thread = threading.Thread(target=fill)
+    thread.daemon = True
+    thread.start()
+    while True:
+        block = queue.get()
+        if block is done:
+            break
+        yield block
+    if error:
+        raise error[0][0], error[0][1], error[0][2]
+
+def read_blocks(filename, windows, indexes=1):
+    with rasterio.open(filename) as src:
+        for window in windows:
+            yield src.read(indexes, window=window)
+
+class RegionStatistic:
+    '''
+    A regional statistic distributed over the cells of its regions, weighted by the bands of a value
+    raster (population density, or land use with scaling factors), as build_region_density_raster
+    followed by distribute_region_statistics.
+    '''
+    def __init__(self, region_shapefile, key, value_raster_file, scale_factors, density_file, output_file):
+        region_stats = extract_region_value(region_shapefile, key)
+        self.region_codes = np.array(sorted(region_stats))
+        #regions without a value for the statistic add nothing
+        self.region_values = np.array([region_stats[code] or 0 for code in self.region_codes], dtype=np.float64)
+        self.key = key
+        self.value_raster_file = value_raster_file
+        self.scale_factors = scale_factors
+        self.density_file = density_file
+        self.output_file = output_file
+        self.region_value_sums = None
+
+    def value_blocks(self, windows):
+        #value bands clipped so that the smallest value is 0
+        for values in read_blocks(self.value_raster_file, windows, range(1, len(self.scale_factors) + 1)):
+            yield np.clip(values, 0, None).astype(np.float64)
+
+    def add_region_sums(self, windows, position_blocks):
+        #first pass: sum of each value band in each region
+        sums = np.zeros((len(self.scale_factors), len(self.region_codes)))
+        for (positions, values) in izip(position_blocks, prefetch(self.value_blocks(windows))):
+            inside = positions >= 0
+            for (band, value_array) in enumerate(values):
+                sums[band] += np.bincount(positions[inside], weights=value_array[inside], minlength=len(self.region_codes))
+        self.region_value_sums = sums
+
+    def blocks(self, windows, position_blocks):
+        #second pass: (density bands, distributed values) of each strip
+        for (positions, values) in izip(position_blocks, prefetch(self.value_blocks(windows))):
+            inside = positions >= 0
+            regional_value_a = np.where(inside, self.region_values[positions], 0)
+
+            density = np.zeros(values.shape)
+            result_a = np.zeros(positions.shape)
+            for (band, f) in enumerate(self.scale_factors):
+                #share of the region's sum in each cell, scaled. 0 outside the regions or where a region sums to 0
+                cell_region_sum = np.where(inside, self.region_value_sums[band][positions], 0)
+                np.divide(values[band], cell_region_sum, out=density[band], where=cell_region_sum > 0)
+                density[band] *= f
+                result_a += density[band] * regional_value_a
+            yield (density, result_a)
+
+def build_region_rasters(region_raster_file, statistics, merged_output_file, min_rows=256):
+    '''
+    Write the density and distributed rasters of each RegionStatistic, and their sum to merged_output_file,
+    streaming strips of rows aligned to the region raster blocks.
+    '''
+    with rasterio.open(region_raster_file) as region_raster:
+        profile = region_raster.profile
+        windows = list(row_windows(region_raster, min_rows))
+
+    def position_blocks(statistic):
+        for region_code_array in prefetch(read_blocks(region_raster_file, windows)):
+            yield region_positions(region_code_array, statistic.region_codes)
+
+    for statistic in statistics:
+        print "summing", statistic.key, "by region from", statistic.value_raster_file
+        statistic.add_region_sums(windows, position_blocks(statistic))
+
+    profile.update(dtype=rasterio.float64)
+    outputs = []
+    try:
+        for statistic in statistics:
+            print "Writing", statistic.key, "to: ", statistic.density_file, statistic.output_file
+            outputs.append((rasterio.open(statistic.density_file, 'w', **dict(profile, count=len(statistic.scale_factors))),
+                            rasterio.open(statistic.output_file, 'w', **dict(profile, count=1))))
+        merged = rasterio.open(merged_output_file, 'w', **dict(profile, count=1))
+        outputs.append((merged,))
+
+        for blocks in izip(windows, *[statistic.blocks(windows, position_blocks(statistic)) for statistic in statistics]):
+            window = blocks[0]
+            merged_a = None
+            for ((density, result_a), (density_out, result_out)) in zip(blocks[1:], outputs):
+                density_out.write(density, window=window)
+                result_out.write(result_a, indexes=1, window=window)
+                merged_a = result_a if merged_a is None else merged_a + result_a
+            merged.write(merged_a, indexes=1, window=window)
+    finally:
+        for datasets in outputs:
+            for dataset in datasets:
+                dataset.close()
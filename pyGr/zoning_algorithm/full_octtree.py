@@ -0,0 +1,71 @@
+import numpy as np
+from integral_image import octtree_depth, node_window
+
+class FullOcttree:
+    '''
+    The complete quadtree over the square envelope, built once down to single cells.
+    Each level is stored as an array of node sums (level 0 is the root, level depth the cells),
+    so the leaf cut for any threshold can be found by walking the sums without building polygons.
+    '''
+    def __init__(self, raster):
+        self.shape = raster.shape
+        self.depth = octtree_depth(raster.shape)
+        n = 2 ** self.depth
+
+        if np.issubdtype(raster.dtype, np.integer):
+            dtype = np.int64
+        else:
+            dtype = np.float64
+
+        #pad to the envelope, clipping at -1 as the window sums do
+        (rows, cols) = raster.shape
+        cells = np.zeros((n, n), dtype=dtype)
+        cells[:rows, :cols] = np.clip(raster, -1, None)
+        if dtype == np.float64:
+            cells[np.isnan(cells)] = 0 #cells without a value add nothing, as in IntegralImage
+
+        self.sums = [cells]
+        for level in xrange(self.depth, 0, -1):
+            m = 2 ** (level - 1)
+            self.sums.insert(0, self.sums[0].reshape(m, 2, m, 2).sum(axis=(1, 3)))
+
+    def total(self):
+        return self.sums[0][0, 0]
+
+    def node_sums(self, level, rows, cols):
+        return self.sums[level][rows, cols]
+
+    def cell_count(self, level, rows, cols):
+        #number of cells of the node that lie inside the raster (the envelope is padded past it)
+        (row_min, row_max, col_min, col_max) = node_window(self.shape, self.depth, level, rows, cols)
+        return (row_max - row_min) * (col_max - col_min)
+
+    def cut(self, pop_threshold):
+        '''
+        Yield (level, rows, cols, values) arrays of the leaves for a threshold, level by level.
+        A node is a leaf if its sum is below the threshold or it covers a single raster cell,
+        the same rule used by octtree.build.
+        '''
+        rows = np.zeros(1, dtype=np.int64)
+        cols = np.zeros(1, dtype=np.int64)
+
+        for level in xrange(self.depth + 1):
+            if not len(rows):
+                break
+            values = self.node_sums(level, rows, cols)
+            is_leaf = (values < pop_threshold) | (self.cell_count(level, rows, cols) == 1)
+            if level == self.depth:
+                is_leaf[:] = True
+
+            yield (level, rows[is_leaf], cols[is_leaf], values[is_leaf])
+
+            #expand the rest into their four children: top left, top right, bottom left, bottom right
+            (rows, cols) = (rows[~is_leaf], cols[~is_leaf])
+            rows = (2 * rows[:, None] + np.array([0, 0, 1, 1])).ravel()
+            cols = (2 * cols[:, None] + np.array([0, 1, 0, 1])).ravel()
+
+    def count(self, pop_threshold):
+        return sum(len(values) for (level, rows, cols, values) in self.cut(pop_threshold))
+
+    def count_populated(self, pop_threshold):
+        return sum(int(np.count_nonzero(values > 0)) for (level, rows, cols, values) in self.cut(pop_threshold))
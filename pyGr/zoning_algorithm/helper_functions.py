@@ -1,53 +1,20 @@
-from shapely.geometry import shape, Polygon, LineString, mapping
+from shapely.geometry import shape, MultiLineString, mapping
 from shapely.ops import cascaded_union
+from shapely.strtree import STRtree
+from shapely import wkb
 from rasterstats import zonal_stats
-import rasterio
+from rasterio.features import rasterize
+from affine import Affine
 import fiona
 from pyGr.common.util import check_and_display_results
+from pyGr.common import raster_access, profiling
 import math
-
-def quarter_polygon(geom_poly):
-    #https://pcjericks.github.io/py-gdalogr-cookbook/geometry.html#quarter-polygon-and-create-centroids
-    (min_x, min_y, max_x, max_y) = geom_poly.bounds
-
-    '''
-    coord0----coord1----coord2
-    |           |           |
-    coord3----coord4----coord5
-    |           |           |
-    coord6----coord7----coord8
-    '''
-    coord0 = min_x, max_y
-    coord1 = min_x+(max_x-min_x)/2, max_y
-    coord2 = max_x, max_y
-    coord3 = min_x, min_y+(max_y-min_y)/2
-    coord4 = min_x+(max_x-min_x)/2, min_y+(max_y-min_y)/2
-    coord5 = max_x, min_y+(max_y-min_y)/2
-    coord6 = min_x, min_y
-    coord7 = min_x+(max_x-min_x)/2, min_y
-    coord8 = max_x, min_y
-
-    polyTopLeft = Polygon([coord0,coord1,coord4,coord3,coord0])
-    polyTopRight = Polygon([coord1,coord2,coord5,coord4,coord1])
-    polyBottomLeft = Polygon([coord3,coord4,coord7,coord6,coord3])
-    polyBottomRight = Polygon([coord4,coord5,coord8,coord7,coord4])
-
-    quarterPolyTopLeft = polyTopLeft.intersection(geom_poly)
-    quarterPolyTopRight =  polyTopRight.intersection(geom_poly)
-    quarterPolyBottomLeft =  polyBottomLeft.intersection(geom_poly)
-    quarterPolyBottomRight =  polyBottomRight.intersection(geom_poly)
-
-    multipolys = [quarterPolyTopLeft, quarterPolyTopRight, quarterPolyBottomLeft, quarterPolyBottomRight]
-    polys = []
-
-    for geom in multipolys:
-        if geom.geom_type in ['MultiPolygon', 'GeometryCollection'] :
-            for geom_part in geom:
-                if geom_part.geom_type == 'Polygon':
-                    polys.append(geom_part)
-        else:
-            polys.append(geom)
-    return polys
+import os
+import struct
+import sqlite3
+import numpy as np
+from collections import defaultdict
+from integral_image import IntegralImage
 
 def get_geom_parts(geom):
     parts = []
@@ -59,8 +26,8 @@ def get_geom_parts(geom):
         parts.append(geom)
     return parts
 
-def calculate_pop_value(node, raster_array, affine):
-    stats = zonal_stats(node.polygon, raster_array, affine=affine, stats="sum", nodata=-1)
+def calculate_pop_value(polygon, raster_array, affine):
+    stats = zonal_stats(polygon, raster_array, affine=affine, stats="sum", nodata=-1)
     total = stats[0]['sum']
     if total:
         return total
@@ -71,88 +38,156 @@ def calculate_pop_value(node, raster_array, affine):
 def compactness_ratio(polygon):
     return math.sqrt((4 * math.pi * polygon.area) / (polygon.exterior.length ** 2))
 
-def is_potential_merge(node, node1, threshold):
-    if (node.index != node1.index
-            and node.value + node1.value < 1.1 * threshold
-            and node.polygon.touches(node1.polygon)) :
-        p_union = node.polygon.union(node1.polygon) #avoid donut shapes
-        return (p_union.geom_type == 'Polygon' and len(p_union.interiors) == 0 # and compactness_ratio(p_union) > 0.6
-            and p_union.is_simple
-            and p_union.centroid.intersects(p_union)
-        )
-    else:
-        return False
-
-
-def find_best_neighbour(node, neighbours, threshold):
-    max_length = 0
-    best_neighbour = None
-    for neighbour in neighbours:
-        if is_potential_merge(node, neighbour, threshold):
-            #neighbour_area = neighbour.polygon.GetArea()
-            length = get_common_boundary(node, neighbour)
-            if length > max_length:
-                max_length = length
-                best_neighbour = neighbour
-
-    return best_neighbour
-
-def get_common_boundary(node1, node2):
-    geom1 = node1.polygon
-    geom2 = node2.polygon
-
-    lines1 = zip(geom1.exterior.coords[0:-1],geom1.exterior.coords[1:])
-    lines2 = zip(geom2.exterior.coords[0:-1],geom2.exterior.coords[1:])
-
-    vert1 = [LineString([(ax,ay),(bx,by)]) for (ax,ay),(bx,by) in lines1 if ax == bx]
-    hori1 = [LineString([(ax,ay),(bx,by)]) for (ax,ay),(bx,by) in lines1 if ay == by]
-
-    vert2 = [LineString([(ax,ay),(bx,by)]) for (ax,ay),(bx,by) in lines2 if ax == bx]
-    hori2 = [LineString([(ax,ay),(bx,by)]) for (ax,ay),(bx,by) in lines2 if ay == by]
-
-    edge_length = 0
-
-    #get all intersecting lines
-    vert_shared = [h1.intersection(h2)
-                   for h1 in vert1
-                   for h2 in vert2]
-
-    hori_shared = [h1.intersection(h2)
-                   for h1 in hori1
-                   for h2 in hori2]
-
-    for l in hori_shared+vert_shared:
-        if l.geometryType() == "LineString":
-            #print l.geometryType(), l, l.length
-            edge_length = edge_length + l.length
+def is_acceptable_union(p_union):
+    #avoid donut shapes
+    return (p_union.geom_type == 'Polygon' and len(p_union.interiors) == 0 # and compactness_ratio(p_union) > 0.6
+        and p_union.is_simple
+        and p_union.centroid.intersects(p_union)
+    )
+
+def build_adjacency(nodes):
+    #adjacency graph of a region's zones: node index -> {neighbour index: shared boundary length}
+    #only zones sharing an edge are linked, zones touching at a corner are not
+    nodes = list(nodes)
+    polygons = [node.polygon for node in nodes]
+    positions = {id(p): i for (i, p) in enumerate(polygons)}
+    polygon_index = STRtree(polygons)
+
+    adjacency = {node.index: {} for node in nodes}
+    for (i, node) in enumerate(nodes):
+        for candidate in polygon_index.query(polygons[i]):
+            j = positions[id(candidate)]
+            if j <= i:
+                continue
+            length = get_common_boundary(polygons[i], polygons[j])
+            if length > 0:
+                adjacency[node.index][nodes[j].index] = length
+                adjacency[nodes[j].index][node.index] = length
+    return adjacency
+
+def get_common_boundary(geom1, geom2):
+    #length of the exterior boundary shared by two polygons. Vertical and horizontal edges are grouped by their
+    #fixed coordinate and compared as intervals, any other edges (from clipping to regions) are left to shapely
+    (vert1, hori1, other1) = split_edges(geom1)
+    (vert2, hori2, other2) = split_edges(geom2)
+
+    edge_length = interval_overlap(vert1, vert2) + interval_overlap(hori1, hori2)
+
+    if other1 and other2:
+        shared = MultiLineString(other1).intersection(MultiLineString(other2))
+        edge_length += sum(l.length for l in get_line_parts(shared))
 
     return edge_length
 
-
+def split_edges(geom):
+    #exterior edges as {x: [(y_min, y_max)]} for vertical edges, {y: [(x_min, x_max)]} for horizontal edges,
+    #and a list of all other edges
+    vert = defaultdict(list)
+    hori = defaultdict(list)
+    other = []
+    coords = geom.exterior.coords
+    for ((ax, ay), (bx, by)) in zip(coords[0:-1], coords[1:]):
+        if ax == bx:
+            vert[ax].append((min(ay, by), max(ay, by)))
+        if ay == by:
+            hori[ay].append((min(ax, bx), max(ax, bx)))
+        if ax != bx and ay != by:
+            other.append(((ax, ay), (bx, by)))
+    return (vert, hori, other)
+
+def interval_overlap(intervals1, intervals2):
+    #total overlap of every pair of intervals sharing a key
+    total = 0
+    for (key, spans) in intervals1.iteritems():
+        for (start2, end2) in intervals2.get(key, ()):
+            for (start1, end1) in spans:
+                overlap = min(end1, end2) - max(start1, start2)
+                if overlap > 0:
+                    total += overlap
+    return total
+
+def get_line_parts(geom):
+    if geom.geom_type == 'LineString':
+        return [geom]
+    elif geom.geom_type in ['MultiLineString', 'GeometryCollection']:
+        return [part for part in geom if part.geom_type == 'LineString']
+    return []
+
+
+@profiling.timed('calculate_final_values', nodes=lambda Config, zone_octtree: zone_octtree.count())
 def calculate_final_values(Config, zone_octtree):
-    with rasterio.open(Config.get("Input","combined_raster")) as combined_rst:
-        combined_array = combined_rst.read(1)
-        combined_affine = combined_rst.affine
-    with rasterio.open(Config.get("Input","pop_raster")) as pop_rst:
-        pop_array = pop_rst.read(1)
-        pop_affine = combined_rst.affine
-    with rasterio.open(Config.get("Input","emp_raster")) as emp_rst:
-        emp_array = emp_rst.read(1)
-        emp_affine = emp_rst.affine
-
-    for zone in zone_octtree.iterate():
-        zs_cmb = zonal_stats(zone.polygon, combined_array, affine=combined_affine, stats='sum')[0]['sum']
-        zs_pop = zonal_stats(zone.polygon, pop_array, affine=pop_affine, stats='sum')[0]['sum']
-        zs_emp = zonal_stats(zone.polygon, emp_array, affine=emp_affine, stats='sum')[0]['sum']
-
-        zone.combined = zs_cmb
-        zone.population = zs_pop
-        zone.employment = zs_emp
+    #sum the combined, population and employment rasters for every zone. Bands are memory mapped when a
+    #cache folder is configured, and only read a strip or a window at a time
+    folder = raster_access.cache_folder(Config)
+    raster_keys = ["combined_raster", "pop_raster", "emp_raster"]
+    bands = [raster_access.RasterBand(Config.get("Input", raster_key), cache_folder=folder) for raster_key in raster_keys]
+    affine = bands[0].affine
+    bands = [band.array for band in bands]
+
+    leaves = zone_octtree.leaves()
+    clipped = np.array([index in zone_octtree.geometries for index in leaves], dtype=bool)
+    sums = np.zeros((len(leaves), len(bands)))
+
+    #grid squares are raster windows, so their sums come straight from a summed-area table
+    grid = leaves[~clipped]
+    for (i, (raster_key, band)) in enumerate(zip(raster_keys, bands)):
+        integral_image = IntegralImage(band, clip_min=None,
+                                       filename=raster_access.table_cache_path(Config, Config.get("Input", raster_key), clip_min=None))
+        sums[~clipped, i] = integral_image.node_sums(zone_octtree.level[grid], zone_octtree.row[grid], zone_octtree.col[grid])
+        del integral_image
+
+    #clipped and merged zones are rasterized once for all bands
+    polygons = [zone_octtree.geometries[index] for index in leaves[clipped]]
+    sums[clipped] = sum_zone_values(polygons, bands, affine)
+
+    zone_octtree.combined[leaves] = sums[:, 0]
+    zone_octtree.population[leaves] = sums[:, 1]
+    zone_octtree.employment[leaves] = sums[:, 2]
+
+def sum_zone_values(polygons, bands, affine, strip_height=raster_access.DEFAULT_STRIP_HEIGHT):
+    '''
+    Sum each of a list of aligned bands within each polygon, counting the cells whose centre is inside it
+    as zonal_stats does. Each band's strip is summed per label with a single bincount, cells without a value (nan)
+    adding nothing, so a zone without any valid cell sums to 0. Returns an array of (polygons, bands)
+    '''
+    sums = np.zeros((len(polygons), len(bands)))
+    for (row_start, row_end, labels) in label_strips(polygons, bands[0].shape, affine, strip_height):
+        labels = labels.ravel()
+        for (i, band) in enumerate(bands):
+            values = np.asarray(band[row_start:row_end], dtype=np.float64).ravel()
+            values = np.where(np.isnan(values), 0, values)
+            sums[:, i] += np.bincount(labels, weights=values, minlength=len(polygons) + 1)[1:]
+    return sums
+
+def label_strips(polygons, (rows, cols), affine, strip_height=raster_access.DEFAULT_STRIP_HEIGHT):
+    '''
+    Burn polygons into a label raster (polygon i is i + 1, 0 elsewhere) one strip of rows at a time,
+    yielding (row_start, row_end, labels). Only the polygons reaching into a strip are rasterized,
+    and strips without any are skipped.
+    '''
+    if not len(polygons):
+        return
 
+    #raster rows spanned by each polygon
+    bounds = np.array([p.bounds for p in polygons])
+    row_a = (bounds[:, 3] - affine.f) / affine.e
+    row_b = (bounds[:, 1] - affine.f) / affine.e
+    top = np.floor(np.minimum(row_a, row_b))
+    bottom = np.ceil(np.maximum(row_a, row_b))
 
-def save(filename, outputSpatialReference, octtree, include_land_use = False, field_values = None):
-    print "saving zones with land use to:", filename
+    for (row_start, row_end) in raster_access.strips(rows, strip_height):
+        in_strip = np.flatnonzero((top < row_end) & (bottom > row_start))
+        if not len(in_strip):
+            continue
 
+        labels = rasterize([(polygons[i], i + 1) for i in in_strip],
+                           out_shape=(row_end - row_start, cols),
+                           transform=affine * Affine.translation(0, row_start),
+                           fill=0, dtype='int32')
+        yield (row_start, row_end, labels)
+
+
+def zone_schema(include_land_use = False, field_values = None):
     schema = {'geometry': 'Polygon',
                 'properties': [('id', 'int'), ('Pop+Emp', 'int'), ('Population', 'int'),
                                ('Employment', 'int'), ('Area', 'float'), ('AGS', 'int')]}
@@ -161,6 +196,13 @@ def save(filename, outputSpatialReference, octtree, include_land_use = False, fi
         for (f, alias) in field_values:
             schema['properties'].append((alias,'float'))
         schema['properties'].append(('remainder', 'float'))
+    return schema
+
+@profiling.timed('save', nodes=lambda filename, reference, octtree, *args, **kwargs: octtree.count())
+def save(filename, outputSpatialReference, octtree, include_land_use = False, field_values = None):
+    print "saving zones with land use to:", filename
+
+    schema = zone_schema(include_land_use, field_values)
 
     with fiona.open(
          filename, 'w',
@@ -178,14 +220,12 @@ def save(filename, outputSpatialReference, octtree, include_land_use = False, fi
                 'Area': zone.polygon.area,
 
             }
-            if  hasattr(zone, 'region'):
+            if zone.region is not None:
                 properties['AGS'] = zone.region['properties']['AGS_Int']
             else:
                 properties['AGS'] = 0
 
-
-
-if include_land_use:
+            if include_land_use:
                 land_use_remainder = 1.0
                 for (f, alias) in field_values:
                     land_use_remainder -= zone.landuse_pc[alias]
@@ -197,8 +237,74 @@ if include_land_use:
                 'properties': properties
             })
 
-from collections import defaultdict
-
+@profiling.timed('save', nodes=lambda filename, reference, octtree, *args, **kwargs: octtree.count())
+def save_geopackage(filename, outputSpatialReference, octtree, include_land_use = False, field_values = None,
+                    batch_size=10000):
+    '''
+    Write the zones to a GeoPackage, with the same fields as save but without the 10 character limit on
+    field names. Fiona only creates the empty layer, the rows are then inserted straight into its sqlite
+    table in batches: attributes are taken from the tree's arrays a column at a time, and geometries are
+    written as WKB with the GeoPackage header. Much faster than save for many zones.
+    '''
+    print "saving zones to geopackage:", filename
+    if os.path.exists(filename):
+        os.remove(filename)
+
+    layer = os.path.splitext(os.path.basename(filename))[0]
+    schema = zone_schema(include_land_use, field_values)
+    #no spatial index, its triggers call functions that only exist inside GDAL
+    with fiona.open(filename, 'w', driver="GPKG", layer=layer, crs=outputSpatialReference, schema=schema,
+                    SPATIAL_INDEX='NO'):
+        pass
+
+    leaves = octtree.leaves()
+    polygons = [octtree.polygon(index) for index in leaves]
+    bounds = np.array([p.bounds for p in polygons]).reshape(-1, 4)
+
+    #AGS of each region, and 0 (last) for zones outside all regions (region index -1)
+    region_ags = np.array([region['properties']['AGS_Int'] for region in octtree.regions] + [0], dtype=np.int64)
+    columns = [np.arange(1, len(leaves) + 1),
+               octtree.combined[leaves].astype(np.int64),
+               octtree.population[leaves].astype(np.int64),
+               octtree.employment[leaves].astype(np.int64),
+               np.array([p.area for p in polygons]),
+               region_ags[octtree.region[leaves]]]
+    if include_land_use:
+        land_use_remainder = np.ones(len(leaves))
+        for (f, alias) in field_values:
+            shares = np.array([octtree.landuse_pc[index][alias] for index in leaves])
+            land_use_remainder -= shares
+            columns.append(shares)
+        columns.append(land_use_remainder)
+    columns = [column.tolist() for column in columns]
+
+    connection = sqlite3.connect(filename)
+    try:
+        (geometry_column, srs_id) = connection.execute(
+            "SELECT column_name, srs_id FROM gpkg_geometry_columns WHERE table_name = ?", (layer,)).fetchone()
+        names = [geometry_column] + [name for (name, field_type) in schema['properties']]
+        insert = 'INSERT INTO "%s" (%s) VALUES (%s)' % (layer, ", ".join('"%s"' % name for name in names),
+                                                         ", ".join("?" * len(names)))
+
+        with connection:
+            for start in xrange(0, len(leaves), batch_size):
+                end = min(start + batch_size, len(leaves))
+                rows = (([geopackage_geometry(polygons[i], srs_id, bounds[i])] + [column[i] for column in columns])
+                        for i in xrange(start, end))
+                connection.executemany(insert, rows)
+
+            if len(leaves):
+                connection.execute("UPDATE gpkg_contents SET min_x = ?, min_y = ?, max_x = ?, max_y = ? WHERE table_name = ?",
+                                   (bounds[:, 0].min(), bounds[:, 1].min(), bounds[:, 2].max(), bounds[:, 3].max(), layer))
+    finally:
+        connection.close()
+
+def geopackage_geometry(polygon, srs_id, (minx, miny, maxx, maxy)):
+    #GeoPackage geometry blob: 'GP', version 0, flags (little endian, xy envelope), srs id and envelope, then the WKB
+    header = struct.pack('<2sBBi4d', 'GP', 0, 0b011, srs_id, minx, maxx, miny, maxy)
+    return sqlite3.Binary(header + wkb.dumps(polygon))
+
+@profiling.timed('validate_zones')
 def validate_zones(region_shapefile, identifier, pop_field, emp_field, zones_shapefile):
     print 'validating zone values against statistics'
     with fiona.open(zones_shapefile) as zs:
@@ -0,0 +1,105 @@
+import os
+import tempfile
+import numpy as np
+from pyGr.common.util import next_power_of_2
+from pyGr.common.raster_access import strips
+
+def octtree_depth((rows, cols)):
+    #number of levels below the root of the square, power of 2 envelope around the raster
+    return next_power_of_2(max(rows, cols)).bit_length() - 1
+
+def node_window((rows, cols), depth, level, node_rows, node_cols):
+    #(row_min, row_max, col_min, col_max) raster window of octtree nodes, clipped to the raster
+    s = 2 ** (depth - np.asarray(level, dtype=np.int64))
+    row_min = np.clip(node_rows * s, 0, rows)
+    row_max = np.clip((node_rows + 1) * s, 0, rows)
+    col_min = np.clip(node_cols * s, 0, cols)
+    col_max = np.clip((node_cols + 1) * s, 0, cols)
+    return (row_min, row_max, col_min, col_max)
+
+class IntegralImage:
+    '''
+    Summed-area table of a raster, built once and reused for every threshold.
+    By default values are clipped at -1 (nodata) before summing, as in the original window sums,
+    so the sum of any octtree node is found with four lookups. A stack of bands (bands, rows, cols)
+    gives one table per band, and sums for every band at once.
+
+    The table is built one strip of rows at a time. Given a filename it is kept in a memory mapped
+    .npy file instead of in memory, so only the entries that are looked up are paged in. A table already in
+    the file with the right shape and type is reused. A new one is written to a temporary file next to it and
+    renamed when done, so a table that another run still has mapped is never overwritten in place.
+    '''
+    def __init__(self, raster, clip_min=-1, filename=None):
+        self.shape = raster.shape[-2:]
+        self.depth = octtree_depth(self.shape)
+
+        #keep integer rasters exact, everything else is summed as float64
+        if np.issubdtype(raster.dtype, np.integer):
+            dtype = np.int64
+        else:
+            dtype = np.float64
+
+        (rows, cols) = self.shape
+        table_shape = raster.shape[:-2] + (rows + 1, cols + 1)
+        if filename is not None and os.path.exists(filename):
+            try:
+                self.table = np.load(filename, mmap_mode='r')
+                if self.table.shape == table_shape and self.table.dtype == dtype:
+                    return
+            except (IOError, ValueError):
+                pass
+
+        if filename is None:
+            self.table = np.zeros(table_shape, dtype=dtype)
+        else:
+            (handle, temp_file) = tempfile.mkstemp(suffix=".npy", dir=os.path.dirname(os.path.abspath(filename)))
+            os.close(handle)
+            self.table = np.lib.format.open_memmap(temp_file, mode='w+', dtype=dtype, shape=table_shape)
+            self.table[..., 0, :] = 0
+            self.table[..., :, 0] = 0
+
+        previous_row = np.zeros(raster.shape[:-2] + (cols,), dtype=dtype)
+        for (row_start, row_end) in strips(rows):
+            strip = raster[..., row_start:row_end, :]
+            if clip_min is not None:
+                strip = np.clip(strip, clip_min, None)
+            strip = strip.astype(dtype)
+            if dtype == np.float64:
+                strip[np.isnan(strip)] = 0 #cells without a value add nothing, as zonal_stats skipped them
+            strip = strip.cumsum(axis=-1).cumsum(axis=-2) + previous_row[..., None, :]
+            self.table[..., row_start + 1:row_end + 1, 1:] = strip
+            previous_row = strip[..., -1, :]
+
+        if filename is not None:
+            self.table.flush()
+            del self.table
+            if os.name == 'nt' and os.path.exists(filename): #rename does not replace an existing file there
+                os.remove(filename)
+            os.rename(temp_file, filename)
+            self.table = np.load(filename, mmap_mode='r')
+
+    def __getstate__(self):
+        #a memory mapped table is pickled as its file name, and opened read only again when unpickled
+        state = self.__dict__.copy()
+        if isinstance(self.table, np.memmap) and self.table.filename:
+            state['table'] = None
+            state['table_file'] = self.table.filename
+        return state
+
+    def __setstate__(self, state):
+        table_file = state.pop('table_file', None)
+        self.__dict__.update(state)
+        if table_file is not None:
+            self.table = np.load(table_file, mmap_mode='r')
+
+    def total(self):
+        return self.table[..., -1, -1]
+
+    def node_sums(self, level, rows, cols):
+        (row_min, row_max, col_min, col_max) = node_window(self.shape, self.depth, level, rows, cols)
+        t = self.table
+        return t[..., row_max, col_max] - t[..., row_min, col_max] - t[..., row_max, col_min] + t[..., row_min, col_min]
+
+    def cell_count(self, level, rows, cols):
+        (row_min, row_max, col_min, col_max) = node_window(self.shape, self.depth, level, rows, cols)
+        return (row_max - row_min) * (col_max - col_min)
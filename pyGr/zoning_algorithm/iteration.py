@@ -1,27 +1,105 @@
 from octtree import build_out_nodes
+from integral_image import IntegralImage
+from full_octtree import FullOcttree
+from pyGr.common import raster_access
+from pyGr.common.region_ops import Regions
 
 import numpy as np
 import csv
 import time
-
-def model_zones_vs_threshold(Config, region_octtree, regions, raster, raster_affine):
+import os
+import shutil
+import tempfile
+import multiprocessing
+
+def trend_thresholds(Config):
+    '''
+    Thresholds for the trend analysis, from Parameters:trend_thresholds. Either a comma separated list,
+    or start:stop:step for a range (stop excluded, as xrange). Defaults to 2000:20000:2000
+    '''
+    spec = "2000:20000:2000"
+    if Config.has_option("Parameters", "trend_thresholds") and Config.get("Parameters", "trend_thresholds"):
+        spec = Config.get("Parameters", "trend_thresholds")
+    if ':' in spec:
+        return range(*[int(part) for part in spec.split(':')])
+    return [int(part) for part in spec.split(',')]
+
+def model_zones_vs_threshold(Config, regions, raster, raster_affine):
+    '''
+    Count the zones each threshold gives, before splitting on region boundaries, and write the
+    (threshold, zones) curve to <Output:filename>.trend.csv. Thresholds are shared between
+    Parameters:trend_processes worker processes, which all read the same memory mapped summed-area table.
+    '''
     print 'running trend analysis...'
-    results = []
-    for pop_threshold in xrange(2000, 20000, 2000):
-        octtree = build_out_nodes(Config, region_octtree, regions, raster, raster_affine, pop_threshold, split=False)
-        num_zones = octtree.count_populated()
-        results.append((pop_threshold, num_zones))
-        print results[-1]
-
-    from matplotlib import pyplot
-
-    pyplot.plot(*zip(*results))
-    pyplot.xlabel('Data Threshold used (population + employment)')
-    pyplot.ylabel('Number of zones created')
-    pyplot.title('Trends of zone size')
-    pyplot.show()
-
-def solve_iteratively(Config, region_octtree, regions, raster, raster_affine):
+    thresholds = trend_thresholds(Config)
+    processes = Config.getint("Parameters", "trend_processes") if Config.has_option("Parameters", "trend_processes") else 1
+
+    #the table goes to the cache folder, or a temporary one, and is opened read only for the workers
+    table_folder = None
+    table_file = raster_access.table_cache_path(Config, Config.get("Input", "combined_raster"))
+    if table_file is None:
+        table_folder = tempfile.mkdtemp(prefix="pygr_trend_")
+        table_file = os.path.join(table_folder, "combined_sat.npy")
+
+    try:
+        integral_image = IntegralImage(raster, filename=table_file)
+        if not isinstance(regions, Regions):
+            regions = Regions(regions)
+        regions.prepared_boundary() #built once, before the workers start
+        #without a split only the shape of the raster is used, so workers are handed the table and the shape
+        worker_args = (Config, regions, raster.shape, raster_affine, integral_image)
+
+        if processes > 1 and len(thresholds) > 1:
+            pool = multiprocessing.Pool(min(processes, len(thresholds)), initializer=_init_worker, initargs=worker_args)
+            try:
+                chunksize = max(1, len(thresholds) // (4 * processes))
+                zone_counts = list(pool.imap(_count_zones, thresholds, chunksize))
+            finally:
+                pool.terminate()
+        else:
+            _init_worker(*worker_args)
+            zone_counts = [_count_zones(pop_threshold) for pop_threshold in thresholds]
+    finally:
+        _init_worker()
+        if table_folder is not None:
+            shutil.rmtree(table_folder, ignore_errors=True)
+
+    results = zip(thresholds, zone_counts)
+    for result in results:
+        print result
+
+    trend_file = Config.get("Output", "filename") + ".trend.csv"
+    with open(trend_file, 'wb') as trend_csv:
+        writer = csv.writer(trend_csv)
+        writer.writerow(['threshold', 'zones'])
+        writer.writerows(results)
+    print "zone counts written to", trend_file
+
+    if Config.has_option("Parameters", "trend_plot") and Config.getboolean("Parameters", "trend_plot"):
+        from matplotlib import pyplot
+
+        pyplot.plot(*zip(*results))
+        pyplot.xlabel('Data Threshold used (population + employment)')
+        pyplot.ylabel('Number of zones created')
+        pyplot.title('Trends of zone size')
+        pyplot.show()
+    return results
+
+_worker_trend = None
+
+def _init_worker(*args):
+    #(Config, regions, raster shape, affine, summed-area table) for _count_zones, no arguments to clear them
+    global _worker_trend
+    _worker_trend = args or None
+
+def _count_zones(pop_threshold):
+    (Config, regions, raster_shape, raster_affine, integral_image) = _worker_trend
+    #a read only view of a single 0 stands in for the raster, only its shape is used
+    octtree = build_out_nodes(Config, regions, np.broadcast_to(0, raster_shape), raster_affine, pop_threshold,
+                              perform_split=False, raster_sums=integral_image)
+    return octtree.count_populated()
+
+def solve_iteratively(Config, regions, raster, raster_affine):
 
     ##
     # if num zones is too large, we need a higher threshold
@@ -32,10 +110,19 @@ def solve_iteratively(Config, region_octtree, regions, raster, raster_affine):
     best_low = Config.getint("Parameters", "lower_population_threshold")
     best_high = Config.getint("Parameters", "upper_population_threshold")
     tolerance =  Config.getfloat("Parameters", "tolerance")
+    use_full_tree = Config.has_option("Parameters", "use_full_tree") and Config.getboolean("Parameters", "use_full_tree")
 
     times = []
+    if use_full_tree:
+        #build every level once, then each step only walks the stored sums. Split and merge run once at the end
+        print 'building full octtree...'
+        raster_sums = FullOcttree(raster)
+    else:
+        #built once, shared by every bisection step
+        raster_sums = IntegralImage(raster, filename=raster_access.table_cache_path(Config, Config.get("Input", "combined_raster")))
+
     if best_low is None or best_low == 0: best_low = 1
-    if best_high is None or best_high == 0: best_high = np.sum(raster)
+    if best_high is None or best_high == 0: best_high = raster_sums.total()
 
     step = 1
     solved = False
@@ -50,8 +137,12 @@ def solve_iteratively(Config, region_octtree, regions, raster, raster_affine):
     while not solved: # difference greater than 10%
         print 'step %d with threshold level %d...' % (step, pop_threshold)
         prev_num_zones = num_zones
-        region_octtree = build_out_nodes(Config, region_octtree, regions, raster, raster_affine, pop_threshold)
-        num_zones = region_octtree.count_populated()
+        if use_full_tree:
+            num_zones = raster_sums.count_populated(pop_threshold)
+        else:
+            zone_octtree = build_out_nodes(Config, regions, raster, raster_affine, pop_threshold,
+                                           raster_sums=raster_sums)
+            num_zones = zone_octtree.count_populated()
         print "\tnumber of cells:", num_zones
         print ''
 
@@ -67,6 +158,11 @@ def solve_iteratively(Config, region_octtree, regions, raster, raster_affine):
 
         times += [[time.time()-start_time, num_zones]]
 
+    if use_full_tree:
+        zone_octtree = build_out_nodes(Config, regions, raster, raster_affine, pop_threshold,
+                                       raster_sums=raster_sums)
+        num_zones = zone_octtree.count_populated()
+
     print "Solution found!"
     print "\t%6d zones" % (num_zones)
     print "\t%6d threshold" % (pop_threshold)
@@ -79,4 +175,4 @@ def solve_iteratively(Config, region_octtree, regions, raster, raster_affine):
         for x in times:
             timewriter.writerow(x)
 
-    return region_octtree
+    return zone_octtree
@@ -1,57 +1,203 @@
-from Queue import Queue
+from collections import defaultdict
+import heapq
+from shapely.geometry import box
+from shapely.strtree import STRtree
 from helper_functions import *
 import numpy as np
-from pyGr.common.region_ops import get_region_boundary
+from pyGr.common.region_ops import Regions
+from pyGr.common import raster_access, profiling
+from integral_image import IntegralImage, octtree_depth
 
-class Octtree:
-    fid_counter = 0
-
-    def __init__(self, polygon):
-        self.polygon = polygon    # instance variable unique to each instance
+#child order matches the old quarter_polygon: top left, top right, bottom left, bottom right
+CHILD_ROWS = np.array([0, 0, 1, 1])
+CHILD_COLS = np.array([0, 1, 0, 1])
 
+class Octtree:
+    '''
+    Array backed octtree. Every node is a row in a set of parallel numpy arrays, and grid nodes are
+    described by (level, row, col) only. Shapely geometry is kept just for nodes whose shape is no
+    longer a grid square, ie leaves clipped by a region boundary or merged with a neighbour.
+
+    The children of a node are stored contiguously from first_child, and are always added after
+    their parent, so a child index is greater than its parent's.
+    '''
+    fields = [('level', np.int8), ('row', np.int32), ('col', np.int32), ('value', np.float64),
+              ('parent', np.int32), ('first_child', np.int32), ('num_children', np.int32),
+              ('alive', np.bool_), ('region', np.int32),
+              ('combined', np.float64), ('population', np.float64), ('employment', np.float64)]
+    defaults = {'parent': -1, 'first_child': -1, 'region': -1, 'alive': True}
+
+    def __init__(self, raster_shape, affine, capacity=1024):
+        self.affine = affine
+        self.depth = octtree_depth(raster_shape)
+        self.size = 0
+        self.capacity = 0
+        self.geometries = {} #node index -> polygon, for nodes that are not grid squares
+        self.regions = [] #region features, referenced by index from the region array
+        self.landuse_pc = {}
+        self.landuse_area = {}
+        self.threshold = None #population threshold the tree was built with
+        self._grow(capacity)
+
+    def _grow(self, capacity):
+        for (name, dtype) in Octtree.fields:
+            array = np.empty(capacity, dtype=dtype)
+            array[:] = Octtree.defaults.get(name, 0)
+            if self.capacity:
+                array[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, array)
+        self.capacity = capacity
+
+    def _allocate(self, n):
+        if self.size + n > self.capacity:
+            self._grow(max(2 * self.capacity, self.size + n))
+        ids = np.arange(self.size, self.size + n)
+        self.size += n
+        return ids
+
+    def add_root(self):
+        return self._allocate(1)
+
+    def add_children(self, parents):
+        #add the four grid quarters of each parent node
+        ids = self._allocate(4 * len(parents))
+        self.first_child[parents] = ids[::4]
+        self.num_children[parents] = 4
+        self.parent[ids] = np.repeat(parents, 4)
+        self.level[ids] = np.repeat(self.level[parents] + 1, 4)
+        self.row[ids] = (2 * self.row[parents][:, None] + CHILD_ROWS).ravel()
+        self.col[ids] = (2 * self.col[parents][:, None] + CHILD_COLS).ravel()
+        return ids
+
+    def add_pieces(self, leaf, polygons, region_indices, values):
+        #add the parts of a leaf clipped by region boundaries as its children
+        ids = self._allocate(len(polygons))
+        self.first_child[leaf] = ids[0]
+        self.num_children[leaf] = len(ids)
+        self.parent[ids] = leaf
+        self.level[ids] = self.level[leaf]
+        self.row[ids] = self.row[leaf]
+        self.col[ids] = self.col[leaf]
+        self.region[ids] = region_indices
+        self.value[ids] = values
+        for (i, polygon) in zip(ids, polygons):
+            self.geometries[int(i)] = polygon
+        return ids
+
+    def remove(self, index):
+        self.alive[index] = False
+
+    def children(self, index):
+        start = self.first_child[index]
+        return np.arange(start, start + self.num_children[index])
+
+    def is_leaf(self, index):
+        return self.num_children[index] == 0
+
+    def leaves(self):
+        n = self.size
+        return np.flatnonzero(self.alive[:n] & (self.num_children[:n] == 0))
+
+    def grid_bounds(self, index):
+        #(minx, miny, maxx, maxy) of the grid square of nodes, works on arrays of indices
+        a = self.affine
+        s = 2 ** (self.depth - self.level[index].astype(np.int64))
+        x0 = a.c + self.col[index] * s * a.a
+        x1 = x0 + s * a.a
+        y0 = a.f + self.row[index] * s * a.e
+        y1 = y0 + s * a.e
+        return (np.minimum(x0, x1), np.minimum(y0, y1), np.maximum(x0, x1), np.maximum(y0, y1))
+
+    def polygon(self, index):
+        if index in self.geometries:
+            return self.geometries[index]
+        return box(*self.grid_bounds(index))
+
+    def set_polygon(self, index, polygon):
+        self.geometries[index] = polygon
 
     def iterate(self):
-        if isinstance(self, OcttreeLeaf):
-            yield self
-        else:
-            for child in self.getChildren():
-                for r in child.iterate():
-                    yield r
-
-    def find_intersections(self, poly):
-
-        if self.polygon.intersects(poly):
-            if isinstance(self, OcttreeLeaf):
-                yield self
-            else:
-                for child in self.getChildren():
-                    for r in child.find_intersections(poly):
-                        yield r
-
-    def find_intersecting_children(self, poly):
-        return [child for child in self.getChildren() if child.polygon.intersects(poly)]
-
-class OcttreeLeaf(Octtree):
-    def __init__(self, polygon, parent):
-        self.polygon = polygon
-        self.value = 0
-        self.parent = parent
-
-        self.index = Octtree.fid_counter
-        Octtree.fid_counter += 1
-
-    def count(self):
-        return 1
+        for index in self.leaves():
+            yield OcttreeLeaf(self, index)
 
-    def count_populated(self):
-        if self.value > 0:
-            return 1
-        else:
-            return 0
+    def count(self): #get total number of leaves
+        return len(self.leaves())
 
-    def prune(self, bounding_geo):
+    def count_populated(self):
+        return int(np.count_nonzero(self.value[self.leaves()] > 0))
+
+    @profiling.timed('prune', nodes=lambda tree, prepared: tree.count())
+    def prune(self, prepared):
+        #remove every node outside the (prepared) bounding area. Nodes inside it keep their whole subtree
+        stack = [0]
+        while stack:
+            index = stack.pop()
+            polygon = self.polygon(index)
+            if not prepared.intersects(polygon):
+                self.alive[index] = False
+            elif not self.is_leaf(index) and not prepared.contains(polygon):
+                stack.extend(self.children(index))
+
+        #clear the subtrees of removed nodes, one generation per pass
+        alive = self.alive[:self.size]
+        parent = self.parent[:self.size]
+        while True:
+            updated = alive[1:] & alive[parent[1:]]
+            if (updated == alive[1:]).all():
+                break
+            alive[1:] = updated
         return self.count()
 
+
+def _tree_property(name):
+    #attribute of a leaf stored in one of the tree's arrays or dicts
+    def fget(self):
+        return getattr(self.tree, name)[self.index]
+    def fset(self, value):
+        getattr(self.tree, name)[self.index] = value
+    return property(fget, fset)
+
+class OcttreeLeaf(object):
+    '''
+    Light view of a leaf of an Octtree. Attributes are read from and written to the tree's arrays
+    '''
+    __slots__ = ('tree', 'index')
+
+    def __init__(self, tree, index):
+        self.tree = tree
+        self.index = int(index)
+
+    def __eq__(self, other):
+        return isinstance(other, OcttreeLeaf) and self.tree is other.tree and self.index == other.index
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return self.index
+
+    value = _tree_property('value')
+    combined = _tree_property('combined')
+    population = _tree_property('population')
+    employment = _tree_property('employment')
+    landuse_pc = _tree_property('landuse_pc')
+    landuse_area = _tree_property('landuse_area')
+
+    @property
+    def polygon(self):
+        return self.tree.polygon(self.index)
+
+    @polygon.setter
+    def polygon(self, polygon):
+        self.tree.set_polygon(self.index, polygon)
+
+    @property
+    def region(self):
+        region_index = self.tree.region[self.index]
+        if region_index < 0:
+            return None
+        return self.tree.regions[region_index]
+
     def is_acceptable(self, Config):
         min_area = Config.getint("Parameters", "minimum_zone_area")
         min_pop = Config.getint("Parameters", "minimum_zone_population")
@@ -65,157 +211,150 @@ class OcttreeLeaf(Octtree):
         return self.polygon.area
 
 
-class OcttreeNode(Octtree):
-    def __init__(self, polygon, children, parent):
-        self.polygon = polygon
-        self.children = children
-        self.parent = parent
-
-    def getChildren(self):
-        return self.children
-
-    def count(self): #get total number of leaves
-        counts = map(lambda x: x.count(), self.children)
-        return sum(counts)
-
-    def count_populated(self): #get total number of leaves
-        counts = map(lambda x: x.count_populated(), self.children)
-        return sum(counts)
-
-    def remove(self, child):
-        if child in self.children:
-            self.children.remove(child)
+def build_out_nodes(Config, regions, raster, raster_affine, pop_threshold, perform_split=True, raster_sums=None):
+    if not isinstance(regions, Regions):
+        regions = Regions(regions)
+    if raster_sums is None: #callers running several thresholds should build an IntegralImage or FullOcttree once
+        raster_sums = IntegralImage(raster, filename=raster_access.table_cache_path(Config, Config.get("Input", "combined_raster")))
 
-    def prune(self, bounding_area):
-        self.children = [child for child in self.children if bounding_area.intersects(child.polygon)]
-        for child in self.children:
-            child.prune(bounding_area)
-        return self.count()
-
-
-def build_out_nodes(Config, region_node, regions, raster, raster_affine, pop_threshold, perform_split=True):
-    Octtree.fid_counter = 0
-
-    octtree_top =  build(region_node.polygon, region_node, raster, raster_affine, pop_threshold)
+    octtree_top = build(Octtree(raster.shape, raster_affine), raster_sums, pop_threshold)
+    octtree_top.threshold = pop_threshold
 
     if perform_split:
         print "\toriginal number zones: ", octtree_top.count_populated()
         to_merge = split(Config, octtree_top, regions, raster, raster_affine)
-        merge(Config, to_merge, pop_threshold)
+        merge(Config, octtree_top, to_merge, pop_threshold)
         print "\tafter split and merge: ", octtree_top.count_populated()
-    bounding_area = get_region_boundary(regions) #need to check against boundary too.
-    octtree_top.prune(bounding_area)
-    # ... do something ...
-    #pr.disable()
-    #pr.dump_stats("data/stats")
-
+    octtree_top.prune(regions.prepared_boundary()) #need to check against boundary too.
 
     return octtree_top
 
 
-def build(box, parent_node, raster, raster_affine, pop_threshold): #list of bottom nodes to work from
-    #run rasterstats with sum and count
-    (x,y,xx,yy) = box.bounds
-    #print "bounds", (x,y,xx,yy)
-    (col1, row1) = ~raster_affine * (x,y)
-    (col2, row2) = ~raster_affine * (xx,yy)
-    #print "window", (row2, row1), (col1, col2)
-
-    r_a = raster[row2:row1, col1:col2]
-    r_a_sum = np.sum(np.clip(r_a,-1, None))
+@profiling.timed('build', nodes=lambda tree, *args: tree.count())
+def build(tree, raster_sums, pop_threshold):
+    #build level by level from the node sums. A node is a leaf if its sum is below the threshold
+    #or it covers a single raster cell, otherwise it is split into 4
+    ids = tree.add_root()
+    for level in xrange(tree.depth + 1):
+        rows = tree.row[ids]
+        cols = tree.col[ids]
+        values = raster_sums.node_sums(level, rows, cols)
+        tree.value[ids] = values
 
-    if r_a_sum < pop_threshold or r_a.size == 1: # leaf #need the count of valid cells
-        leaf = OcttreeLeaf(box, parent_node)
-        leaf.value = r_a_sum
-        if leaf.value == None: leaf.value = 0
-        return leaf
+        to_split = ~((values < pop_threshold) | (raster_sums.cell_count(level, rows, cols) == 1))
+        if level == tree.depth or not to_split.any():
+            break
+        ids = tree.add_children(ids[to_split])
 
-    else:  #if np.sum(array) >= pop_threshold and array.size >= 4: # leaf
-        #split box into 4
-        #recurse to leafs for each subpolygon
-        sub_polygons = quarter_polygon(box)
-        node = OcttreeNode(box, None, parent_node)
-
-        children = [build(sub, node, raster, raster_affine, pop_threshold)
-                    for sub in sub_polygons if sub.geom_type == 'Polygon'] #type 3 is polygon
-        node.children = children
-        return node
+    return tree
 
+@profiling.timed('split', nodes=lambda Config, tree, *args: tree.count())
 def split(Config, tree, regions, raster, raster_affine):
     print "running splice algorithm..."
 
+    tree.regions = regions
     region_results = []
-    nodes_to_delete = set()
-
-    for region in regions:
-        region_results.append({'region':region, 'all':set(), 'to_merge':set()})
-        region_poly = shape(region['geometry'])
-        node_queue = Queue()
-        node_queue.put(tree)
-        while not node_queue.empty():
-
-            #print node_queue.qsize()
-            #for all intersecting nodes, create a new node from the intersection, and mark the old one for deletion
-            top = node_queue.get()
-            nodes_inside_region = top.find_intersecting_children(region_poly)
-
-            for child in nodes_inside_region:
-                if isinstance(child, OcttreeLeaf):
-                    if child.polygon.within(region_poly): #inside, so keep and all to list of all nodes (unles on total boundary)
-                        region_results[-1]['all'].add(child)
-                        child.region = region
-                    else: #on a border, split
+    pieces = defaultdict(list) #leaf index -> [(region index, polygon)], added once all regions are checked
 
-                        intersection = child.polygon.intersection(region_poly) #Check that intersection is a polygon
+    #index the leaf squares once, then query the index with each region
+    leaves = tree.leaves()
+    (minx, miny, maxx, maxy) = tree.grid_bounds(leaves)
+    leaf_boxes = [box(*b) for b in zip(minx, miny, maxx, maxy)]
+    leaf_positions = {id(b): i for (i, b) in enumerate(leaf_boxes)}
+    leaf_index = STRtree(leaf_boxes)
 
-                        intersections_list = get_geom_parts(intersection)
-
-                        for intersection in intersections_list:
-                            spliced_node = OcttreeLeaf(intersection, child.parent)
-                            spliced_node.region = region
-                            region_results[-1]['all'].add(spliced_node)
-                            #calculate new population value
-                            spliced_node.value = calculate_pop_value(spliced_node, raster, raster_affine)
-
-                            child.parent.children.append(spliced_node)
-                            region_results[-1]['to_merge'].add(spliced_node)
-
-                            nodes_to_delete.add(child)
-                else:
-                    node_queue.put(child)
-
-
-    #remove any nodes outside boundary:
-    for node in nodes_to_delete:
-        node.parent.remove(node)
+    for (region_index, region) in enumerate(regions):
+        region_results.append({'region':region, 'all':set(), 'to_merge':set()})
+        region_poly = regions.geometries[region_index]
+        prepared = regions.prepared[region_index]
+        (r_minx, r_miny, r_maxx, r_maxy) = regions.bounds[region_index]
+
+        candidates = np.array(sorted(leaf_positions[id(b)] for b in leaf_index.query(region_poly)), dtype=np.int64)
+        #a leaf reaching past the region's bounding box cannot be within it, so skip the exact test for those
+        in_bounds = ((minx[candidates] >= r_minx) & (maxx[candidates] <= r_maxx)
+                     & (miny[candidates] >= r_miny) & (maxy[candidates] <= r_maxy))
+
+        for (position, may_be_within) in zip(candidates, in_bounds):
+            index = leaves[position]
+            leaf_box = leaf_boxes[position]
+            if may_be_within and prepared.contains(leaf_box): #inside, so keep and all to list of all nodes (unles on total boundary)
+                region_results[-1]['all'].add(OcttreeLeaf(tree, index))
+                tree.region[index] = region_index
+            elif prepared.intersects(leaf_box): #on a border, split
+                intersection = leaf_box.intersection(region_poly) #Check that intersection is a polygon
+                for part in get_geom_parts(intersection):
+                    pieces[index].append((region_index, part))
+
+    #replace each border leaf by its pieces
+    for leaf in sorted(pieces):
+        (region_indices, polygons) = zip(*pieces[leaf])
+        values = [calculate_pop_value(polygon, raster, raster_affine) for polygon in polygons]
+        ids = tree.add_pieces(leaf, polygons, region_indices, values)
+
+        for (index, region_index) in zip(ids, region_indices):
+            spliced_node = OcttreeLeaf(tree, index)
+            region_results[region_index]['all'].add(spliced_node)
+            region_results[region_index]['to_merge'].add(spliced_node)
 
     return region_results
 
 
 
-def merge(Config, region_results, threshold):
+@profiling.timed('merge', nodes=lambda Config, tree, *args: tree.count())
+def merge(Config, tree, region_results, threshold):
+    #merge the split pieces of each region into their neighbours. The region adjacency graph is built once,
+    #candidate merges are taken longest shared boundary first, and only the edges of merged zones are updated
     print "running merging"
     for l in region_results:
-        merge_set = l['to_merge']
         region_nodes = l['all']
-        while len(merge_set):
-            node = merge_set.pop()
-
-            if len(region_nodes) == 1:
-                #only one in region.
-                if node not in node.parent.children:
-                    node.parent.children.append(node)
-            else:
-                best_neighbour = find_best_neighbour(node, region_nodes, threshold)
-                if best_neighbour:
-                    best_neighbour.polygon = best_neighbour.polygon.union(node.polygon)
-                    best_neighbour.value = best_neighbour.value + node.value
-
-                    node.parent.remove(node)
-                    region_nodes.remove(node)
-
-                    merge_set.add(best_neighbour)
-
-                    #if not best_neighbour.is_acceptable(Config):
-                     #   merge_set.add(best_neighbour)
-
+        if len(region_nodes) < 2: #only one in the region, so keep it
+            continue
+
+        nodes = {node.index: node for node in region_nodes}
+        adjacency = build_adjacency(region_nodes)
+        to_merge = set(node.index for node in l['to_merge'])
+        version = defaultdict(int) #bumped when a zone grows, so queued merges using its old shape are skipped
+        queue = []
+
+        def push(index, neighbour):
+            #queue merging zone index into neighbour
+            heapq.heappush(queue, (-adjacency[index][neighbour], index, neighbour, version[index], version[neighbour]))
+
+        for index in to_merge:
+            for neighbour in adjacency[index]:
+                push(index, neighbour)
+
+        while queue:
+            (_, index, neighbour, index_version, neighbour_version) = heapq.heappop(queue)
+            if (index not in adjacency or neighbour not in adjacency
+                    or version[index] != index_version or version[neighbour] != neighbour_version):
+                continue
+
+            node = nodes[index]
+            best_neighbour = nodes[neighbour]
+            if node.value + best_neighbour.value >= 1.1 * threshold:
+                continue
+            p_union = best_neighbour.polygon.union(node.polygon)
+            if not is_acceptable_union(p_union):
+                continue
+
+            best_neighbour.polygon = p_union
+            best_neighbour.value = best_neighbour.value + node.value
+
+            tree.remove(index)
+            region_nodes.remove(node)
+            to_merge.discard(index)
+
+            #the merged zone takes over the removed zone's edges, shared lengths add up
+            for (other, length) in adjacency.pop(index).iteritems():
+                del adjacency[other][index]
+                if other != neighbour:
+                    adjacency[neighbour][other] = adjacency[neighbour].get(other, 0) + length
+                    adjacency[other][neighbour] = adjacency[neighbour][other]
+
+            version[neighbour] += 1
+            to_merge.add(neighbour)
+            for other in adjacency[neighbour]:
+                push(neighbour, other)
+                if other in to_merge:
+                    push(other, neighbour)
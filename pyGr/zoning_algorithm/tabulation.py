@@ -1,68 +1,194 @@
 import os
+import multiprocessing
 import fiona
+import rasterio
+import numpy as np
 from shapely.geometry import shape
-def run_tabulate_intersection(zone_octtree, land_use_folder, class_field, field_values):
-    print field_values
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+from helper_functions import label_strips
+from pyGr.common import profiling
 
-    #set value for each zones and class to zero
-    for zone in zone_octtree.iterate():
-        zone.landuse_pc = {}
-        zone.landuse_area = {}
-        for (field, class_alias) in field_values:
-            zone.landuse_pc[class_alias] = 0
-            zone.landuse_area[class_alias] = 0
+class ZoneIndex:
+    '''
+    The final zones, indexed once per run in an STRtree so each land use feature only meets the zones
+    its bounding box overlaps. Grid zones are rectangles, so a feature inside one is found from the
+    bounds alone, clipped and merged zones use a prepared geometry (prepared on first use).
+
+    Pickling keeps only the polygons and which of them are boxes, the index is rebuilt when unpickled
+    (ie: in worker processes that are not forked), and the zones are left behind.
+    '''
+    def __init__(self, zone_octtree):
+        self.zones = list(zone_octtree.iterate())
+        self._index([zone.polygon for zone in self.zones],
+                    np.array([zone.index not in zone_octtree.geometries for zone in self.zones], dtype=bool))
+
+    def _index(self, polygons, is_box):
+        self.polygons = polygons
+        self.is_box = is_box
+        self.areas = np.array([polygon.area for polygon in self.polygons])
+        self.bounds = np.array([polygon.bounds for polygon in self.polygons]).reshape(-1, 4)
+        self.positions = {id(polygon): i for (i, polygon) in enumerate(self.polygons)}
+        self.tree = STRtree(self.polygons)
+        self.prepared = {}
+
+    def __getstate__(self):
+        return {'polygons': self.polygons, 'is_box': self.is_box}
+
+    def __setstate__(self, state):
+        self.zones = None
+        self._index(state['polygons'], state['is_box'])
+
+    def __len__(self):
+        return len(self.polygons)
+
+    def contains(self, i, poly, (minx, miny, maxx, maxy)):
+        (z_minx, z_miny, z_maxx, z_maxy) = self.bounds[i]
+        if minx < z_minx or miny < z_miny or maxx > z_maxx or maxy > z_maxy:
+            return False
+        if self.is_box[i]:
+            return True
+        if i not in self.prepared:
+            self.prepared[i] = prep(self.polygons[i])
+        return self.prepared[i].contains(poly)
+
+    def intersection_areas(self, poly):
+        '''
+        (zone position, area) of the intersection of poly with each zone it overlaps.
+        Zones do not overlap, so a feature completely inside one zone is credited in full to it alone.
+        '''
+        bounds = poly.bounds
+        candidates = sorted(self.positions[id(p)] for p in self.tree.query(poly))
+        for i in candidates:
+            if self.contains(i, poly, bounds):
+                return [(i, poly.area)]
+
+        results = []
+        for i in candidates:
+            area = self.polygons[i].intersection(poly).area
+            if area > 0:
+                results.append((i, area))
+        return results
+
+@profiling.timed('tabulation', nodes=lambda zone_octtree, *args: zone_octtree.count())
+def run_tabulate_intersection(zone_octtree, land_use_folder, class_field, field_values, processes=1):
+    print field_values
 
     print "running intersection tabulation"
+    zone_index = ZoneIndex(zone_octtree)
+    areas = np.zeros((len(zone_index), len(field_values))) #area of each class in each zone
 
     print land_use_folder
-    checked_features = set() #need to make sure that we dont double count features that are in two files (rely on unique OIDs)
-
-    for folder in os.listdir(land_use_folder):
+    #districts are taken in sorted order, a feature in two of them (same OID) is counted in the first
+    shapefiles = []
+    for folder in sorted(os.listdir(land_use_folder)):
         folder_abs = os.path.join(land_use_folder, folder)
         if os.path.isdir(folder_abs):
             #find siedlung shapefile name
             seidlung_path = [os.path.splitext(filename)[0]
                              for filename in os.listdir(folder_abs) if 'Siedlung' in filename][0]
+            shapefiles.append(os.path.join(folder_abs, seidlung_path + ".shp"))
 
-            full_sp_path = os.path.join(folder_abs, seidlung_path + ".shp")
-            tabulate_intersection(zone_octtree, full_sp_path, checked_features, class_field, field_values)
+    checked_features = set() #need to make sure that we dont double count features that are in two files (rely on unique OIDs)
+    tasks = [(shapefile, class_field, field_values) for shapefile in shapefiles]
+    if processes > 1 and len(shapefiles) > 1:
+        #each worker is handed the zone index once, already built when forked. Results come back, and are added,
+        #in district order
+        pool = multiprocessing.Pool(min(processes, len(shapefiles)), initializer=_init_worker, initargs=(zone_index,))
+        try:
+            for result in pool.imap(_tabulate_district, tasks):
+                add_district(areas, checked_features, *result)
+        finally:
+            pool.terminate()
+    else:
+        for (shapefile, class_field, field_values) in tasks:
+            result = tabulate_intersection(zone_index, shapefile, class_field, field_values, skip=checked_features)
+            add_district(areas, checked_features, *result)
+
+    set_land_use(zone_index.zones, zone_index.areas, areas, field_values)
+
+@profiling.timed('tabulation', nodes=lambda zone_octtree, *args: zone_octtree.count())
+def run_tabulate_raster(zone_octtree, land_use_raster, field_values):
+    '''
+    Approximate land use tabulation from the land use raster built in pre-processing (merged_land_use_10m.tif,
+    cells hold the class encoding, 1 for the first class in field_values and so on). Zone ids are burnt into
+    a raster on the same grid one strip at a time, and the cells of each (zone, class) are counted with
+    a single bincount. A cell counts for the zone its centre falls in, so shares are only as exact as the grid.
+    '''
+    print "running raster tabulation"
+    print '\t', land_use_raster, '...'
+    zones = list(zone_octtree.iterate())
+    polygons = [zone.polygon for zone in zones]
+    num_classes = len(field_values)
+    counts = np.zeros((len(zones) + 1) * (num_classes + 1), dtype=np.int64)
 
-def tabulate_intersection(zone_octtree, shapefile, checked_features, class_field, field_values):
-    #print "running intersection tabulation"
-    (land_types, land_type_aliases) = zip(*field_values)
+    with rasterio.open(land_use_raster) as src:
+        cell_area = abs(src.affine.a * src.affine.e)
+        for (row_start, row_end, labels) in label_strips(polygons, (src.height, src.width), src.affine):
+            classes = src.read(1, window=((row_start, row_end), (0, src.width)))
+            #nodata and codes of classes not in field_values count as class 0, which is dropped
+            classes = np.where((classes > 0) & (classes <= num_classes), classes, 0)
+            counts += np.bincount((labels * (num_classes + 1) + classes).ravel(), minlength=len(counts))
+
+    areas = counts.reshape(len(zones) + 1, num_classes + 1)[1:, 1:] * cell_area
+    set_land_use(zones, np.array([polygon.area for polygon in polygons]), areas, field_values)
+
+def set_land_use(zones, zone_areas, areas, field_values):
+    #set the area and share of each class for every zone, zero where a class was not found
+    for (i, zone) in enumerate(zones):
+        zone.landuse_pc = {}
+        zone.landuse_area = {}
+        for (c, (field, class_alias)) in enumerate(field_values):
+            zone.landuse_pc[class_alias] = areas[i, c] / zone_areas[i]
+            zone.landuse_area[class_alias] = areas[i, c]
+
+_worker_zone_index = None
+
+def _init_worker(zone_index):
+    global _worker_zone_index
+    _worker_zone_index = zone_index
+
+def _tabulate_district((shapefile, class_field, field_values)):
+    return tabulate_intersection(_worker_zone_index, shapefile, class_field, field_values)
+
+def tabulate_intersection(zone_index, shapefile, class_field, field_values, skip=()):
+    '''
+    Intersect the features of one land use shapefile with the zones. Returns the OIDs of all features
+    in file order, and for the features of a wanted class the pieces (feature, zone, class, area) as arrays,
+    so that districts can be tabulated independently and only counted once a feature's OID is known to be new.
+    Features with an OID in skip (already counted) are not intersected
+    '''
+    land_types = {land_type: c for (c, (land_type, alias)) in enumerate(field_values)}
+    oids = []
+    (features, zones, classes, areas) = ([], [], [], [])
     with fiona.open(shapefile) as src:
         print '\t' , shapefile, '...'
 
         for feature in src:
-            oid = feature['properties']['OID']
-            if oid not in checked_features:
-                checked_features.add(oid)
-                #need to check the OID. If it has already been checked in another land use file, ignore.
-                #get class
-                poly_class = feature['properties'][class_field].lower()
-                if poly_class in land_types: #*zip means unzip. Only work with land types we want
-                    class_alias = land_type_aliases[land_types.index(poly_class)] #make faster?
-                    #transform
-                    poly = shape(feature['geometry'])
-
-                    matches = find_intersections(zone_octtree, poly)
-
-                    for zone in matches:
-                        #print zone.index, class_name, percentage
-                        intersection = zone.polygon.intersection(poly)
-                        pc_coverage = intersection.area / zone.polygon.area
-                        zone.landuse_pc[class_alias] += pc_coverage
-                        zone.landuse_area[class_alias] += intersection.area
-
-def find_intersections(node, poly):
-    matches = []
-
-    if node.polygon.intersects(poly):
-        try:
-            for child in node.getChildren():
-                matches.extend(find_intersections(child, poly))
-        except AttributeError: #octtreeleaf
-            matches.append(node)
+            oids.append(feature['properties']['OID'])
+            #get class
+            poly_class = feature['properties'][class_field].lower()
+            if poly_class in land_types and oids[-1] not in skip: #Only work with land types we want
+                c = land_types[poly_class]
+                poly = shape(feature['geometry'])
+
+                for (i, area) in zone_index.intersection_areas(poly):
+                    features.append(len(oids) - 1)
+                    zones.append(i)
+                    classes.append(c)
+                    areas.append(area)
+
+    return (oids, np.array(features, dtype=np.int64), np.array(zones, dtype=np.int64),
+            np.array(classes, dtype=np.int64), np.array(areas, dtype=np.float64))
 
-    return matches
+def add_district(areas, checked_features, oids, features, zones, classes, piece_areas):
+    #add the pieces of the features not already counted in an earlier district. add.at adds in order,
+    #so the sums are the same as adding feature by feature
+    is_new = np.zeros(len(oids), dtype=bool)
+    for (f, oid) in enumerate(oids):
+        if oid not in checked_features:
+            checked_features.add(oid)
+            is_new[f] = True
 
+    keep = is_new[features]
+    np.add.at(areas, (zones[keep], classes[keep]), piece_areas[keep])
@@ -0,0 +1,97 @@
+'''
+Cache of the final zones, so that runs which only change the land use tabulation, validation or output
+skip the zoning algorithm.
+
+A zone set is stored under a key hashed from the contents of the combined, population and employment
+rasters, the region shapefile and the zoning Parameters, in a compressed .npz file in the folder set by
+Input:zone_cache. Each zone is kept as its row of the octtree arrays (grid position, region index and
+values), and the clipped and merged zones as WKB, so a cached zone set loads back as an Octtree of
+leaves that save and tabulation use as before.
+'''
+import os
+import numpy as np
+from affine import Affine
+from shapely import wkb
+
+from pyGr.common.stages import Stage, StageRunner
+from octtree import Octtree
+
+#bump when the stored arrays change, so older cache files are no longer used
+CACHE_VERSION = 1
+CACHED_FIELDS = ['level', 'row', 'col', 'value', 'region', 'combined', 'population', 'employment']
+
+def zone_cache_folder(Config):
+    #folder for cached zone sets, from the optional Input:zone_cache setting
+    if Config.has_option("Input", "zone_cache") and Config.get("Input", "zone_cache"):
+        folder = Config.get("Input", "zone_cache")
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        return folder
+    return None
+
+def cache_file(Config):
+    #file the zones of this configuration are cached in, or None without a cache folder
+    folder = zone_cache_folder(Config)
+    if folder is None:
+        return None
+
+    regions_file = Config.get("Regions", "filename")
+    if not os.path.exists(regions_file) and os.path.exists(regions_file + ".shp"):
+        regions_file += ".shp"
+    inputs = [Config.get("Input", raster_key) for raster_key in ["combined_raster", "pop_raster", "emp_raster"]]
+    #the Trend mode settings do not change the zones
+    params = dict([(name, value) for (name, value) in Config.items("Parameters") if not name.startswith("trend_")],
+                  version=CACHE_VERSION)
+
+    #hashed like a pre-processing stage, file hashes are remembered in the cache folder
+    runner = StageRunner(os.path.join(folder, "file_hashes.json"))
+    key = runner.stage_hash(Stage("zones", None, inputs + [regions_file], params=params))
+    runner.save_hash_cache()
+    return os.path.join(folder, "zones_%s.npz" % key)
+
+def save(filename, tree):
+    leaves = tree.leaves()
+    clipped = np.array([index in tree.geometries for index in leaves], dtype=bool)
+    geometries = [wkb.dumps(tree.geometries[index]) for index in leaves[clipped]]
+    a = tree.affine
+
+    arrays = {name: getattr(tree, name)[leaves] for name in CACHED_FIELDS}
+    arrays['clipped'] = clipped
+    arrays['wkb'] = np.frombuffer(b''.join(geometries), dtype=np.uint8)
+    arrays['wkb_offsets'] = np.cumsum([0] + [len(g) for g in geometries]).astype(np.int64)
+    arrays['affine'] = np.array([a.a, a.b, a.c, a.d, a.e, a.f])
+    arrays['depth'] = tree.depth
+    arrays['threshold'] = tree.threshold if tree.threshold is not None else -1
+
+    #written under another name first, so an interrupted run does not leave a partial cache file
+    temp_file = filename + ".part"
+    with open(temp_file, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.rename(temp_file, filename)
+    print "cached %d zones in %s" % (len(leaves), filename)
+
+def load(filename, regions):
+    '''
+    The cached zones as an Octtree whose nodes are all leaves, with regions indexed by the stored
+    region positions. None if nothing is cached for filename
+    '''
+    if filename is None or not os.path.exists(filename):
+        return None
+
+    with np.load(filename) as cached:
+        tree = Octtree((1, 1), Affine(*cached['affine']), capacity=max(1, len(cached['level'])))
+        tree.depth = int(cached['depth'])
+        ids = tree._allocate(len(cached['level']))
+        for name in CACHED_FIELDS:
+            getattr(tree, name)[ids] = cached[name]
+
+        (data, offsets) = (cached['wkb'].tostring(), cached['wkb_offsets'])
+        for (i, index) in enumerate(ids[cached['clipped']]):
+            tree.geometries[int(index)] = wkb.loads(data[offsets[i]:offsets[i + 1]])
+
+        threshold = int(cached['threshold'])
+        tree.threshold = threshold if threshold >= 0 else None
+
+    tree.regions = regions
+    print "loaded %d zones (threshold %s) from %s" % (tree.size, tree.threshold, filename)
+    return tree
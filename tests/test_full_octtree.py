@@ -0,0 +1,37 @@
+import unittest
+
+import numpy as np
+
+from pyGr.zoning_algorithm.full_octtree import FullOcttree
+from pyGr.zoning_algorithm.integral_image import IntegralImage
+
+
+class FullOcttreeTest(unittest.TestCase):
+    def nan_raster(self):
+        rs = np.random.RandomState(0)
+        raster = rs.uniform(-1, 10, (50, 40))
+        raster[7, 13] = np.nan
+        return raster
+
+    def test_node_sums_match_integral_image_with_nan(self):
+        raster = self.nan_raster()
+        full = FullOcttree(raster)
+        integral_image = IntegralImage(raster)
+
+        self.assertFalse(np.isnan(full.total()))
+        self.assertAlmostEqual(full.total(), integral_image.total())
+        for level in xrange(full.depth + 1):
+            (rows, cols) = np.mgrid[0:2 ** level, 0:2 ** level]
+            (rows, cols) = (rows.ravel(), cols.ravel())
+            np.testing.assert_allclose(full.node_sums(level, rows, cols), integral_image.node_sums(level, rows, cols),
+                                       atol=1e-9)
+
+    def test_nan_cell_does_not_force_splits(self):
+        raster = self.nan_raster()
+        clean = raster.copy()
+        clean[7, 13] = 0
+        self.assertEqual(FullOcttree(raster).count(100), FullOcttree(clean).count(100))
+
+
+if __name__ == '__main__':
+    unittest.main()